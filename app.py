@@ -1,18 +1,45 @@
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from collections import namedtuple
 import sqlite3
-from flask import Flask, render_template, request, redirect, session, flash, url_for
+from flask import Flask, render_template, request, redirect, session, flash, url_for, g, Response, stream_with_context, make_response, has_request_context, has_app_context, template_rendered, before_render_template
+from flask.sessions import SessionInterface, SessionMixin
+from flask.json.tag import TaggedJSONSerializer
+from werkzeug.datastructures import CallbackDict
+from markupsafe import Markup
 from werkzeug.security import generate_password_hash, check_password_hash
 import os
 import random
 import math
 import logging
+import logging.handlers
+import atexit
 import uuid
 import re
+import queue
+import threading
+import time
+import functools
+import bisect
+import secrets
+import concurrent.futures
+import csv
+import io
+import json
+import base64
+import click
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+import limits
+from limits.storage import Storage, MovingWindowSupport
+from limits.strategies import STRATEGIES as LIMIT_STRATEGIES
 import pyotp
 import qrcode   
+import qrcode.image.svg
 import bleach
+try:
+    import fcntl
+except ImportError:  # windows, LOG_FILE has to be given a {pid} there to run more than one process
+    fcntl = None
 
 app = Flask(__name__)
 app.secret_key = os.getenv("APP_SECRET_KEY")
@@ -27,6 +54,21 @@ COLOURS = ["#AEC6CF",
 TYPES = ['teacher', 'student']
 ALLOWED_TAGS = ['b', 'i', 'u', 'strong', 'em', 'a']
 ALLOWED_ATTRIBUTES = {'a': ['href', 'title']}
+SESSIONS_PER_PAGE = 50
+MAX_SESSIONS_PER_PAGE = 200
+EXPORT_FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+EXPORT_COLUMNS = ['session_id', 'class', 'start_time', 'end_time', 'duration_seconds', 'description']
+JOIN_CODE_ATTEMPTS = 10
+MAX_ROSTER_SIZE = 1000
+MFA_QR_TTL = 600  # seconds a rendered setup QR code is reused for
+MFA_QR_CACHE_SIZE = 256
+SQL_VARIABLE_CHUNK = 500  # stays under sqlite's 999 bound parameter limit on older builds
+RATE_LIMIT_EXEMPT_ENDPOINTS = {'static', 'health', 'metrics'}
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]  # seconds
+QUERY_COUNT_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200]
+SLOW_QUERY_PLAN_CACHE_SIZE = 256
+LOG_SHUTDOWN_TIMEOUT = 5  # seconds to wait for queued log records to be written on exit
+LAYOUT_CONTEXT = ['classes']  # variables layout_user.html reads outside the body block, stored with a cached body
 
 app.config.update(
     SESSION_COOKIE_SECURE=True,  # Enforces HTTPS for session cookies
@@ -34,8 +76,584 @@ app.config.update(
     SESSION_COOKIE_SAMESITE='Strict'  # Prevents cross-site request forgery (CSRF)
 )
 
+app.config.update(
+    DATABASE=os.getenv("DATABASE_PATH", 'study_app.db'),
+    DB_POOL_SIZE=int(os.getenv("DB_POOL_SIZE", 8)),  # Max connections open at once
+    DB_POOL_TIMEOUT=float(os.getenv("DB_POOL_TIMEOUT", 10)),  # Seconds to wait for a free connection
+    DB_JOURNAL_MODE=os.getenv("DB_JOURNAL_MODE", 'WAL'),  # WAL lets readers carry on while a write is in progress
+    DB_SYNCHRONOUS=os.getenv("DB_SYNCHRONOUS", 'NORMAL'),
+    DB_BUSY_TIMEOUT_MS=int(os.getenv("DB_BUSY_TIMEOUT_MS", 5000)),  # How long sqlite waits on a lock before giving up
+    DB_CACHE_SIZE_KB=int(os.getenv("DB_CACHE_SIZE_KB", 16384)),  # Page cache per connection
+    DB_MMAP_SIZE=int(os.getenv("DB_MMAP_SIZE", 64 * 1024 * 1024)),
+    DB_WRITE_RETRIES=int(os.getenv("DB_WRITE_RETRIES", 3)),
+    DB_RETRY_BACKOFF=float(os.getenv("DB_RETRY_BACKOFF", 0.05))  # Seconds, doubled on each retry
+)
+
+app.config.update(
+    PASSWORD_HASH_METHOD=os.getenv("PASSWORD_HASH_METHOD", 'scrypt'),  # werkzeug method string, e.g. scrypt:32768:8:1 or pbkdf2:sha256:1000000
+    PASSWORD_HASH_WORKERS=int(os.getenv("PASSWORD_HASH_WORKERS", 4)),  # Hashes computed at once
+    PASSWORD_HASH_QUEUE=int(os.getenv("PASSWORD_HASH_QUEUE", 16)),  # Hashes allowed to wait for a worker before logins are turned away
+    PASSWORD_HASH_TIMEOUT=float(os.getenv("PASSWORD_HASH_TIMEOUT", 10))  # Seconds a request waits for its hash
+)
+
+app.config.update(
+    LOG_FILE=os.getenv("LOG_FILE", 'record.log'),  # {pid} is replaced by the process id, use it with several worker processes
+    LOG_LEVEL=os.getenv("LOG_LEVEL", 'INFO').upper(),  # DEBUG also records library debug output
+    LOG_MAX_BYTES=int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024)),  # Rotate once the file reaches this size...
+    LOG_ROTATE_HOURS=float(os.getenv("LOG_ROTATE_HOURS", 24)),  # ...or this much time has passed, whichever is first
+    LOG_BACKUP_COUNT=int(os.getenv("LOG_BACKUP_COUNT", 7)),  # Rotated files kept as record.log.1 .. record.log.N
+    LOG_QUEUE_SIZE=int(os.getenv("LOG_QUEUE_SIZE", 10000))  # Records waiting for the writer thread before new ones are dropped
+)
+
+app.config.update(
+    METRICS_ENABLED=os.getenv("METRICS_ENABLED", 'false').lower() in ('1', 'true', 'yes'),  # Serve per endpoint histograms at /metrics
+    SLOW_QUERY_MS=float(os.getenv("SLOW_QUERY_MS", 0)),  # Log statements slower than this with their query plan, 0 turns it off
+    SLOW_QUERY_SAMPLE_RATE=float(os.getenv("SLOW_QUERY_SAMPLE_RATE", 1)),  # Fraction of slow statements that get logged
+    SLOW_QUERY_PLAN_TTL=float(os.getenv("SLOW_QUERY_PLAN_TTL", 300))  # Seconds a query's plan is reused before it is explained again
+)
+
+app.config.update(
+    RATELIMIT_STORAGE_URI=os.getenv("RATELIMIT_STORAGE_URI", 'memory://'),  # sqlite:///ratelimit.db shares counters between worker processes
+    RATELIMIT_STRATEGY=os.getenv("RATELIMIT_STRATEGY", 'fixed-window')  # or moving-window, fixed-window-elastic-expiry needs limits 4, others fall back to fixed-window
+)
+
+app.config.update(
+    VIEW_CACHE_MAX_BYTES=int(os.getenv("VIEW_CACHE_MAX_BYTES", 128 * 1024 * 1024)),  # Rendered dashboard, tasks and class pages kept per process, 0 turns the cache off
+    VIEW_CACHE_TTL=float(os.getenv("VIEW_CACHE_TTL", 300))  # Seconds a cached page is reused for, bounds how stale date based text (overdue, last 30 days) can get
+)
+
+app.config.update(
+    SESSION_BACKEND=os.getenv("SESSION_BACKEND", 'cookie'),  # 'sqlite' keeps session data server side with only an id in the cookie
+    SESSION_CACHE_SIZE=int(os.getenv("SESSION_CACHE_SIZE", 1024))  # Sessions kept in memory per process in front of the table
+)
+
+def configure_db(conn):
+    # these pragmas only last for the connection so they run on every new one
+    conn.execute(f"PRAGMA busy_timeout = {int(app.config['DB_BUSY_TIMEOUT_MS'])}")
+    conn.execute(f"PRAGMA synchronous = {app.config['DB_SYNCHRONOUS']}")
+    conn.execute(f"PRAGMA cache_size = -{int(app.config['DB_CACHE_SIZE_KB'])}")  # negative means KiB rather than pages
+    conn.execute(f"PRAGMA mmap_size = {int(app.config['DB_MMAP_SIZE'])}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
+def connect_db():
+    # check_same_thread is off because pooled connections get handed between worker threads
+    if instrumentation_enabled():
+        conn = sqlite3.connect(app.config['DATABASE'], check_same_thread=False, factory=InstrumentedConnection)
+        conn.set_trace_callback(count_statement)
+    else:
+        conn = sqlite3.connect(app.config['DATABASE'], check_same_thread=False)
+    return configure_db(conn)
+
+def instrumentation_enabled():
+    return app.config['METRICS_ENABLED'] or app.config['SLOW_QUERY_MS'] > 0 or app.debug
+
+def count_statement(statement):
+    # statements run by triggers are reported too, they start with a comment naming the trigger
+    if has_app_context() and not statement.startswith('--'):
+        g.sql_queries = g.get('sql_queries', 0) + 1
+
+def add_sql_time(elapsed):
+    if has_app_context():
+        g.sql_time = g.get('sql_time', 0.0) + elapsed
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Adds time spent in sqlite, stepping through rows included, to the current request's SQL time"""
+    statement = None  # the statement this cursor last ran, fetch time keeps adding to it
+
+    def timed(self, method, *args):
+        start = time.perf_counter()
+        try:
+            return method(self, *args)
+        finally:
+            elapsed = time.perf_counter() - start
+            add_sql_time(elapsed)
+            statement = self.statement
+            if statement is not None:
+                statement['seconds'] += elapsed
+                if not statement['flagged'] and 0 < app.config['SLOW_QUERY_MS'] <= statement['seconds'] * 1000:
+                    flag_slow_query(statement)
+
+    def start_statement(self, sql, parameters):
+        # generators given to executemany can only be read once so their shape isn't recorded
+        if not isinstance(parameters, (list, tuple, dict)):
+            parameters = None
+        self.statement = {'sql': sql, 'parameters': parameters, 'seconds': 0.0, 'flagged': False, 'connection': self.connection}
+
+    def execute(self, sql, parameters=()):
+        self.start_statement(sql, parameters)
+        return self.timed(sqlite3.Cursor.execute, sql, parameters)
+
+    def executemany(self, sql, parameters):
+        self.start_statement(sql, parameters)
+        return self.timed(sqlite3.Cursor.executemany, sql, parameters)
+
+    def executescript(self, *args):
+        self.statement = None
+        return self.timed(sqlite3.Cursor.executescript, *args)
+
+    def fetchone(self):
+        return self.timed(sqlite3.Cursor.fetchone)
+
+    def fetchmany(self, *args):
+        return self.timed(sqlite3.Cursor.fetchmany, *args)
+
+    def fetchall(self):
+        return self.timed(sqlite3.Cursor.fetchall)
+
+    def __next__(self):
+        return self.timed(sqlite3.Cursor.__next__)
+
+def flag_slow_query(statement):
+    statement['flagged'] = True
+    # logged when the request ends so the duration includes fetching the rest of the rows
+    if has_app_context():
+        g.setdefault('slow_queries', []).append(statement)
+    else:
+        log_slow_query(statement)
+
+def normalize_sql(sql):
+    # literals in f-string built queries become ? so the same query always logs the same way
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+(?:\.\d+)?\b', '?', sql)
+    return ' '.join(sql.split())
+
+def parameters_shape(parameters):
+    # types only, the values can be password hashes or other private data
+    if parameters is None:
+        return 'unknown'
+    if isinstance(parameters, dict):
+        return {name: type(value).__name__ for name, value in parameters.items()}
+    if parameters and isinstance(parameters[0], (list, tuple, dict)):
+        return f'{len(parameters)} rows of {parameters_shape(parameters[0])}'
+    return [type(value).__name__ for value in parameters]
+
+slow_query_plans = {}
+slow_query_plans_lock = threading.Lock()
+
+def explain_query(statement, normalized):
+    """EXPLAIN QUERY PLAN detail lines, reused for SLOW_QUERY_PLAN_TTL so a query that is always slow is only explained now and then"""
+    now = time.monotonic()
+    with slow_query_plans_lock:
+        cached = slow_query_plans.get(normalized)
+        if cached and cached[0] > now:
+            return cached[1]
+    parameters = statement['parameters']
+    if parameters and isinstance(parameters, list) and isinstance(parameters[0], (list, tuple, dict)):
+        parameters = parameters[0]  # executemany, explain it with the first row
+    try:
+        # a plain cursor so explaining isn't itself timed and flagged
+        rows = sqlite3.Cursor(statement['connection']).execute('EXPLAIN QUERY PLAN ' + statement['sql'], parameters or ()).fetchall()
+        plan = [row[3] for row in rows]
+    except sqlite3.Error as e:
+        plan = [f'could not explain: {e}']
+    with slow_query_plans_lock:
+        if len(slow_query_plans) >= SLOW_QUERY_PLAN_CACHE_SIZE:
+            del slow_query_plans[next(iter(slow_query_plans))]
+        slow_query_plans[normalized] = (now + app.config['SLOW_QUERY_PLAN_TTL'], plan)
+    return plan
+
+def log_slow_query(statement):
+    # sampled here so queries outside a request (migrations, cli commands, bench scripts) follow the rate too
+    if random.random() >= app.config['SLOW_QUERY_SAMPLE_RATE']:
+        return
+    normalized = normalize_sql(statement['sql'])
+    plan = explain_query(statement, normalized)
+    # SCAN without an index means every row of the table was read
+    full_scan = any(line.startswith('SCAN ') and 'INDEX' not in line and 'CONSTANT' not in line for line in plan)
+    duration_ms = round(statement['seconds'] * 1000, 2)
+    app.logger.warning(f'Slow query ({duration_ms} ms{", full scan" if full_scan else ""}): {normalized}',
+                       extra={'sql': normalized, 'parameters': parameters_shape(statement['parameters']),
+                              'duration_ms': duration_ms, 'plan': plan, 'full_scan': full_scan})
+
+class InstrumentedConnection(sqlite3.Connection):
+    # conn.execute() goes through cursor() as well so this covers both styles used in the app
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+def is_locked_error(error):
+    message = str(error).lower()
+    return 'database is locked' in message or 'database is busy' in message
+
+def retry_on_locked(view):
+    """Re-runs a view that writes if sqlite still reports the database as locked after busy_timeout"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        retries = app.config['DB_WRITE_RETRIES']
+        for attempt in range(retries + 1):
+            try:
+                return view(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if not is_locked_error(e) or attempt == retries:
+                    raise
+                if 'db' in g and g.db.in_transaction:
+                    g.db.rollback()
+                delay = app.config['DB_RETRY_BACKOFF'] * (2 ** attempt)
+                app.logger.warning(f'Database locked in {request.endpoint}, retrying in {delay:.2f}s')
+                time.sleep(delay + random.uniform(0, delay))  # jitter so competing writers don't retry in lockstep
+    return wrapper
+
+class ConnectionPool:
+    """Bounded pool of sqlite connections, one is lent to each request"""
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.opened < self.size:
+                self.opened += 1
+                try:
+                    return connect_db()
+                except sqlite3.Error:
+                    self.opened -= 1
+                    raise
+        # pool is exhausted so wait for another request to hand one back
+        try:
+            return self.idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError('Timed out waiting for a database connection')
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()  # never hand uncommitted work to the next request
+            self.idle.put_nowait(conn)
+        except sqlite3.Error:
+            self.discard(conn)
+
+    def discard(self, conn):
+        with self.lock:
+            self.opened -= 1
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def close_all(self):
+        while True:
+            try:
+                self.discard(self.idle.get_nowait())
+            except queue.Empty:
+                break
+
+def get_pool():
+    pool = app.extensions.get('db_pool')
+    if pool is None:
+        pool = ConnectionPool(app.config['DB_POOL_SIZE'], app.config['DB_POOL_TIMEOUT'])
+        app.extensions['db_pool'] = pool
+    return pool
+
+class PasswordHasherBusy(Exception):
+    pass
+
+class PasswordHasher:
+    """Runs password hashing on a fixed set of worker threads with a cap on how many can queue up"""
+    def __init__(self, method, workers, queue_size, timeout):
+        self.method = method
+        self.timeout = timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def run(self, function, *args):
+        # hashlib drops the GIL while hashing so the workers really do run in parallel
+        if not self.slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+        try:
+            future = self.executor.submit(function, *args)
+        except RuntimeError:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda future: self.slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except concurrent.futures.TimeoutError:
+            raise PasswordHasherBusy()
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        return self.run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        # the part before the first $ is the method and its parameters, e.g. scrypt:32768:8:1
+        return password_hash.split('$', 1)[0] != hash_prefix(self.method)
+
+@functools.lru_cache(maxsize=None)
+def hash_prefix(method):
+    # werkzeug fills in default parameters ('scrypt' -> 'scrypt:32768:8:1'), hashing once is the simplest way to see them
+    return generate_password_hash('', method).split('$', 1)[0]
+
+def get_password_hasher():
+    hasher = app.extensions.get('password_hasher')
+    if hasher is None:
+        hasher = PasswordHasher(app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_HASH_WORKERS'],
+                                app.config['PASSWORD_HASH_QUEUE'], app.config['PASSWORD_HASH_TIMEOUT'])
+        app.extensions['password_hasher'] = hasher
+    return hasher
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, version=0, expires_at=0, stored=None):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.version = version
+        self.expires_at = expires_at
+        self.stored = stored  # serialized data as loaded, to tell real changes apart from rewrites of the same value
+        self.new = sid is None
+        self.modified = False
+        self.regenerate_sid = False
+
+    def regenerate(self):
+        """Gives the session a new id when it is next saved, the old row is deleted"""
+        self.regenerate_sid = True
+        self.modified = True
+
+class SqliteSessionInterface(SessionInterface):
+    """Keeps session data in the web_sessions table, the cookie only holds '<session id>.<version>'"""
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, cache_size):
+        self.cache_size = cache_size
+        self.cache = {}  # sid -> (version, data, expires_at), oldest first
+        self.lock = threading.Lock()
+
+    def cache_get(self, sid, version):
+        with self.lock:
+            entry = self.cache.pop(sid, None)
+            if entry is None:
+                return None
+            self.cache[sid] = entry
+        # the cookie always carries the latest version, so an older entry means another process has written since
+        return entry if entry[0] == version else None
+
+    def cache_put(self, sid, entry):
+        if self.cache_size <= 0:
+            return
+        with self.lock:
+            self.cache.pop(sid, None)
+            if len(self.cache) >= self.cache_size:
+                del self.cache[next(iter(self.cache))]
+            self.cache[sid] = entry
+
+    def cache_drop(self, sid):
+        with self.lock:
+            self.cache.pop(sid, None)
+
+    def lifetime(self, app):
+        return int(app.permanent_session_lifetime.total_seconds())
+
+    def open_session(self, app, request):
+        sid, _, version = request.cookies.get(self.get_cookie_name(app), '').partition('.')
+        if not sid or not version.isdigit():
+            return ServerSession()
+        version = int(version)
+        now = int(time.time())
+        entry = self.cache_get(sid, version)
+        # the expiry is pushed forward without a new version, so check the table before trusting a cached expiry
+        if entry is None or entry[2] <= now:
+            row = get_db().execute("SELECT version, data, expires_at FROM web_sessions WHERE session_id = ?", (sid,)).fetchone()
+            if row is None:
+                return ServerSession()
+            entry = tuple(row)
+            self.cache_put(sid, entry)
+        if entry[2] <= now:
+            return ServerSession()
+        return ServerSession(self.serializer.loads(entry[1]), sid, entry[0], entry[2], entry[1])
+
+    def set_cookie(self, app, session, response):
+        response.set_cookie(self.get_cookie_name(app), f'{session.sid}.{session.version}',
+                            expires=self.get_expiration_time(app, session), httponly=self.get_cookie_httponly(app),
+                            domain=self.get_cookie_domain(app), path=self.get_cookie_path(app),
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+        response.vary.add('Cookie')
+
+    def session_db(self):
+        conn = get_db()
+        # anything the view left uncommitted would be rolled back on release, don't let the session write commit it
+        if conn.in_transaction:
+            conn.rollback()
+        return conn
+
+    def save_session(self, app, session, response):
+        if session.accessed:
+            response.vary.add('Cookie')
+        now = int(time.time())
+        # a visitor who hasn't logged in only has the permanent flag, no need to store a row for them
+        if not session.keys() - {'_permanent'}:
+            if session.sid is not None:
+                conn = self.session_db()
+                conn.execute("DELETE FROM web_sessions WHERE session_id = ?", (session.sid,))
+                conn.commit()
+                self.cache_drop(session.sid)
+                response.delete_cookie(self.get_cookie_name(app), domain=self.get_cookie_domain(app),
+                                       path=self.get_cookie_path(app), secure=self.get_cookie_secure(app),
+                                       samesite=self.get_cookie_samesite(app), httponly=self.get_cookie_httponly(app))
+                response.vary.add('Cookie')
+            return
+        data = self.serializer.dumps(dict(session))
+        lifetime = self.lifetime(app)
+        if session.new or session.regenerate_sid or data != session.stored:
+            conn = self.session_db()
+            if session.regenerate_sid and session.sid is not None:
+                # an id from before login may have been planted by someone else, it must not carry over
+                conn.execute("DELETE FROM web_sessions WHERE session_id = ?", (session.sid,))
+                self.cache_drop(session.sid)
+                session.sid = None
+                session.version = 0
+            if session.sid is None:
+                session.sid = secrets.token_urlsafe(32)
+            session.expires_at = now + lifetime
+            # bumped in sql, two requests that loaded the same version must still end up with different ones
+            session.version = conn.execute('''
+                INSERT INTO web_sessions (session_id, version, data, expires_at) VALUES (?, 1, ?, ?)
+                ON CONFLICT(session_id) DO UPDATE SET version = web_sessions.version + 1, data = excluded.data, expires_at = excluded.expires_at
+                RETURNING version
+                ''', (session.sid, data, session.expires_at)).fetchone()[0]
+            if random.random() < 0.01:
+                conn.execute("DELETE FROM web_sessions WHERE expires_at <= ?", (now,))
+        elif session.expires_at - now < lifetime // 2:
+            # sliding expiry, but only written once per half lifetime rather than on every request
+            session.expires_at = now + lifetime
+            conn = self.session_db()
+            conn.execute("UPDATE web_sessions SET expires_at = ? WHERE session_id = ?", (session.expires_at, session.sid))
+        else:
+            return
+        conn.commit()
+        self.cache_put(session.sid, (session.version, data, session.expires_at))
+        self.set_cookie(app, session, response)
+
+    def get_expiration_time(self, app, session):
+        if session.permanent:
+            return datetime.fromtimestamp(session.expires_at, timezone.utc)
+        return None
+
+class SqliteLimiterStorage(Storage, MovingWindowSupport):
+    """Rate limit counters in a sqlite file so every worker process on the host sees the same limits"""
+    STORAGE_SCHEME = ['sqlite']
+    STRATEGIES = {'fixed-window', 'fixed-window-elastic-expiry', 'moving-window'}  # the ones incr and acquire_entry cover
+
+    def __init__(self, uri, wrap_exceptions=False, **options):
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        # sqlite:///ratelimit.db is relative to the working directory, sqlite:////tmp/ratelimit.db is absolute
+        self.path = uri[len('sqlite:///'):]
+        self.local = threading.local()
+        conn = self.connect()
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS counters(key TEXT PRIMARY KEY, count INTEGER NOT NULL, expires_at REAL NOT NULL) WITHOUT ROWID")
+        conn.execute("CREATE TABLE IF NOT EXISTS window_entries(key TEXT NOT NULL, ts REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_window_entries_key_ts ON window_entries(key, ts)")
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def connect(self):
+        # a connection per thread, autocommit so the writes below can take the lock up front with BEGIN IMMEDIATE
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None)
+            conn.execute(f"PRAGMA busy_timeout = {int(app.config['DB_BUSY_TIMEOUT_MS'])}")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def incr(self, key, expiry, elastic_expiry=False, amount=1):
+        # limits 4 passes elastic_expiry (True for the fixed-window-elastic-expiry strategy), limits 5 only passes amount
+        now = time.time()
+        conn = self.connect()
+        count = conn.execute('''
+            INSERT INTO counters (key, count, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                count = CASE WHEN expires_at <= ? THEN excluded.count ELSE count + excluded.count END,
+                expires_at = CASE WHEN ? OR expires_at <= ? THEN excluded.expires_at ELSE expires_at END
+            RETURNING count
+            ''', (key, amount, now + expiry, now, bool(elastic_expiry), now)).fetchone()[0]
+        if random.random() < 0.001:
+            conn.execute("DELETE FROM counters WHERE expires_at <= ?", (now,))
+        return count
+
+    def get(self, key):
+        row = self.connect().execute("SELECT count FROM counters WHERE key = ? AND expires_at > ?", (key, time.time())).fetchone()
+        return row[0] if row else 0
+
+    def get_expiry(self, key):
+        now = time.time()
+        row = self.connect().execute("SELECT expires_at FROM counters WHERE key = ? AND expires_at > ?", (key, now)).fetchone()
+        return row[0] if row else now
+
+    def check(self):
+        try:
+            self.connect().execute("SELECT 1")
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self):
+        conn = self.connect()
+        cleared = conn.execute("DELETE FROM counters").rowcount
+        conn.execute("DELETE FROM window_entries")
+        return cleared
+
+    def clear(self, key):
+        conn = self.connect()
+        conn.execute("DELETE FROM counters WHERE key = ?", (key,))
+        conn.execute("DELETE FROM window_entries WHERE key = ?", (key,))
+
+    def acquire_entry(self, key, limit, expiry, amount=1):
+        if amount > limit:
+            return False
+        now = time.time()
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM window_entries WHERE key = ? AND ts <= ?", (key, now - expiry))
+            acquired = conn.execute("SELECT COUNT(*) FROM window_entries WHERE key = ?", (key,)).fetchone()[0]
+            if acquired + amount > limit:
+                conn.execute("COMMIT")
+                return False
+            conn.executemany("INSERT INTO window_entries (key, ts) VALUES (?, ?)", [(key, now)] * amount)
+            conn.execute("COMMIT")
+            return True
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get_moving_window(self, key, limit, expiry):
+        now = time.time()
+        oldest, acquired = self.connect().execute("SELECT MIN(ts), COUNT(*) FROM window_entries WHERE key = ? AND ts > ?",
+                                                  (key, now - expiry)).fetchone()
+        return (oldest, acquired) if acquired else (now, 0)
+
+def rate_limit_key():
+    # logged in users get their own bucket so a classroom behind one NAT address doesn't share a limit
+    if session.get('user_id'):
+        return f"{session['user_type']}:{session['user_id']}"
+    return get_remote_address()
+
+def get_db():
+    # every helper in a request shares the one connection stored on g
+    if 'db' not in g:
+        g.db = get_pool().acquire()
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        get_pool().release(conn)
+
 def init_db():
-    conn = sqlite3.connect('study_app.db')
+    conn = connect_db()
     cursor = conn.cursor()
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS students(
@@ -120,16 +738,309 @@ def init_db():
         )
         ''')
     conn.commit()
+    # journal mode is stored in the database file so it only needs setting once at startup
+    cursor.execute(f"PRAGMA journal_mode = {app.config['DB_JOURNAL_MODE']}").fetchone()
+    migrate_db(conn)
     conn.close()
 
+def migration_add_indexes(cursor):
+    # dashboard, /sessions and get_daily_totals look sessions up by student, view_class by class
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_study_sessions_student_start ON study_sessions(student_id, start_time)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_study_sessions_student_end ON study_sessions(student_id, end_time)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_study_sessions_class_start ON study_sessions(class_id, start_time)")
+    # covers the completion counts in get_tasks without touching the table
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_student_tasks_teacher_task ON student_tasks(teacher_task_id, completed, student_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_student_tasks_student ON student_tasks(student_id, completed, created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_teacher_tasks_class ON teacher_tasks(class_id, created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_classes_teacher ON classes(teacher_id)")
+    # the primary key starts with class_id so lookups by student alone need their own index
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_classes_students_student ON classes_students(student_id, class_id)")
+
+def add_column(cursor, table, column, definition):
+    # sqlite has no ADD COLUMN IF NOT EXISTS so check first to keep migrations re-runnable
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def migration_session_epochs(cursor):
+    # text timestamps were written both with and without microseconds, epochs make durations a plain subtraction
+    add_column(cursor, 'study_sessions', 'start_ts', 'INTEGER')
+    add_column(cursor, 'study_sessions', 'end_ts', 'INTEGER')
+    add_column(cursor, 'study_sessions', 'duration_seconds', 'INTEGER')
+    # the text columns hold local time, 'utc' converts them the same way datetime.timestamp() does
+    cursor.execute('''
+        UPDATE study_sessions
+        SET start_ts = CAST(strftime('%s', start_time, 'utc') AS INTEGER),
+            end_ts = CAST(strftime('%s', end_time, 'utc') AS INTEGER)
+        WHERE start_ts IS NULL OR end_ts IS NULL
+    ''')
+    cursor.execute("UPDATE study_sessions SET duration_seconds = MAX(end_ts - start_ts, 0) WHERE duration_seconds IS NULL")
+    cursor.execute("DROP INDEX IF EXISTS idx_study_sessions_student_start")
+    cursor.execute("DROP INDEX IF EXISTS idx_study_sessions_student_end")
+    cursor.execute("DROP INDEX IF EXISTS idx_study_sessions_class_start")
+    # duration is included so daily totals are answered from the index alone
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_study_sessions_student_start_ts ON study_sessions(student_id, start_ts, duration_seconds)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_study_sessions_student_end_ts ON study_sessions(student_id, end_ts)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_study_sessions_class_start_ts ON study_sessions(class_id, start_ts)")
+
+def migration_daily_totals(cursor):
+    # per student, class and day rollup so the dashboard chart reads a handful of rows instead of grouping every session
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS daily_study_totals(
+        student_id INTEGER NOT NULL,
+        class_id INTEGER NOT NULL,
+        day DATE NOT NULL,
+        seconds INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (student_id, day, class_id)
+        ) WITHOUT ROWID
+        ''')
+    rebuild_daily_totals(cursor)
+
+def migration_study_time_adjustment(cursor):
+    # total_study_time = sum of the student's sessions in the class + study_time_adjustment
+    add_column(cursor, 'classes_students', 'study_time_adjustment', 'INTEGER NOT NULL DEFAULT 0')
+    # past teacher edits only exist in the totals, keep them by turning the difference into the adjustment
+    cursor.execute('''
+        UPDATE classes_students
+        SET study_time_adjustment = total_study_time - COALESCE((
+            SELECT SUM(duration_seconds) FROM study_sessions
+            WHERE study_sessions.class_id = classes_students.class_id
+            AND study_sessions.student_id = classes_students.student_id
+        ), 0)
+    ''')
+
+def migration_active_timers(cursor):
+    # one running timer per student, replaces the stopwatch fields that used to be in the session cookie
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS active_timers(
+        student_id INTEGER PRIMARY KEY,
+        class_id INTEGER NOT NULL,
+        started_ts INTEGER NOT NULL,
+        FOREIGN KEY (class_id, student_id) REFERENCES classes_students(class_id, student_id)
+        )
+        ''')
+
+def migration_allocate_join_codes(cursor):
+    # codes used to be set on the first view_class, give every class one up front
+    # and replace any that lost a leading 0 to the INTEGER column
+    cursor.execute("SELECT class_id FROM classes WHERE join_code IS NULL OR join_code < 100000")
+    for (class_id,) in cursor.fetchall():
+        allocate_join_code(cursor, class_id)
+
+def migration_assign_missed_tasks(cursor):
+    # the NOT EXISTS check in assign_teacher_tasks looks up one (task, student) pair at a time
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_student_tasks_task_student ON student_tasks(teacher_task_id, student_id)")
+    # students who joined after a task was set never got it
+    assign_teacher_tasks(cursor, outstanding_only=True)
+
+# (role, old table, old id column) for the compatibility views over accounts
+ACCOUNT_TABLES = [('student', 'students', 'student_id'), ('teacher', 'teachers', 'teacher_id')]
+
+def unused_username(cursor, username):
+    # the students and teachers tables, or views once accounts exists, so this works before and after migration 8
+    candidate, n = username, 1
+    while cursor.execute("SELECT 1 FROM students WHERE username = ? UNION ALL SELECT 1 FROM teachers WHERE username = ?", (candidate, candidate)).fetchone():
+        n += 1
+        candidate = f'{username}-{n}'
+    return candidate
+
+def migration_unified_accounts(cursor):
+    # one table for both roles so a username is found with a single indexed lookup
+    # user_id keeps the old student_id/teacher_id so nothing that references them has to change
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS accounts(
+        account_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        role TEXT NOT NULL CHECK (role IN ('student', 'teacher')),
+        user_id INTEGER NOT NULL,
+        username TEXT NOT NULL,
+        password TEXT NOT NULL,
+        name TEXT NOT NULL,
+        mfa_secret TEXT,
+        UNIQUE (role, user_id)
+        )
+        ''')
+    # usernames were only checked against the other table by find_duplicate, rename any that slipped through
+    cursor.execute('''
+        SELECT teacher_id, username FROM teachers
+        WHERE username IN (SELECT username FROM students)
+    ''')
+    for teacher_id, username in cursor.fetchall():
+        new_username = unused_username(cursor, f'{username}-teacher{teacher_id}')
+        app.logger.warning(f'Teacher:{teacher_id} username {username} is also a student, renamed to {new_username}')
+        cursor.execute("UPDATE teachers SET username = ? WHERE teacher_id = ?", (new_username, teacher_id))
+    for role, table, id_column in ACCOUNT_TABLES:
+        cursor.execute(f'''
+            INSERT INTO accounts (role, user_id, username, password, name, mfa_secret)
+            SELECT ?, {id_column}, username, password, name, mfa_secret FROM {table}
+        ''', (role,))
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_accounts_username ON accounts(username)")
+    # new accounts use their account_id as user_id, start it past every id either table has handed out
+    # so ids are never reused and a new student can't share an id with a teacher
+    cursor.execute("INSERT INTO sqlite_sequence (name, seq) SELECT 'accounts', 0 WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'accounts')")
+    cursor.execute('''
+        UPDATE sqlite_sequence
+        SET seq = MAX(seq, COALESCE((SELECT MAX(seq) FROM sqlite_sequence WHERE name IN ('students', 'teachers')), 0),
+                      COALESCE((SELECT MAX(user_id) FROM accounts), 0))
+        WHERE name = 'accounts'
+    ''')
+    for role, table, id_column in ACCOUNT_TABLES:
+        cursor.execute(f"DROP TABLE {table}")
+        # views with the old columns keep joins like students.student_id working
+        cursor.execute(f'''
+            CREATE VIEW {table} AS
+            SELECT user_id AS {id_column}, username, password, name, mfa_secret FROM accounts WHERE role = '{role}'
+        ''')
+        # an explicit id moves the sequence past it so later accounts can't be given the same one
+        cursor.execute(f'''
+            CREATE TRIGGER {table}_insert INSTEAD OF INSERT ON {table}
+            BEGIN
+                INSERT INTO accounts (role, user_id, username, password, name, mfa_secret)
+                VALUES ('{role}', COALESCE(NEW.{id_column}, (SELECT seq FROM sqlite_sequence WHERE name = 'accounts') + 1, 1),
+                        NEW.username, NEW.password, NEW.name, NEW.mfa_secret);
+                UPDATE sqlite_sequence SET seq = MAX(seq, COALESCE(NEW.{id_column}, 0)) WHERE name = 'accounts';
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER {table}_update INSTEAD OF UPDATE ON {table}
+            BEGIN
+                UPDATE accounts SET user_id = NEW.{id_column}, username = NEW.username, password = NEW.password,
+                                    name = NEW.name, mfa_secret = NEW.mfa_secret
+                WHERE role = '{role}' AND user_id = OLD.{id_column};
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER {table}_delete INSTEAD OF DELETE ON {table}
+            BEGIN
+                DELETE FROM accounts WHERE role = '{role}' AND user_id = OLD.{id_column};
+            END
+        ''')
+
+def migration_web_sessions(cursor):
+    # only used when SESSION_BACKEND is sqlite but created either way so switching backends needs no migration
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS web_sessions(
+        session_id TEXT PRIMARY KEY,
+        version INTEGER NOT NULL,
+        data TEXT NOT NULL,
+        expires_at INTEGER NOT NULL
+        ) WITHOUT ROWID
+        ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_web_sessions_expires ON web_sessions(expires_at)")
+
+# (table, scopes) - cache_versions rows bumped when a row changes, ROW becomes NEW or OLD
+CACHE_VERSION_TRIGGERS = [
+    ('study_sessions', ["'student:' || ROW.student_id", "'class:' || ROW.class_id"]),
+    ('classes_students', ["'student:' || ROW.student_id", "'class:' || ROW.class_id"]),
+    ('student_tasks', ["'student:' || ROW.student_id",
+                       "'class:' || COALESCE(ROW.class_id, (SELECT class_id FROM teacher_tasks WHERE teacher_task_id = ROW.teacher_task_id))"]),
+    ('teacher_tasks', ["'class:' || ROW.class_id"]),
+    ('classes', ["'class:' || ROW.class_id", "'teacher:' || ROW.teacher_id"]),
+]
+
+def bump_cache_version_sql(scope):
+    # selecting through a subquery skips a NULL scope, e.g. a task whose teacher task was deleted first
+    return f"""INSERT INTO cache_versions (scope, version) SELECT scope, 1 FROM (SELECT {scope} AS scope) WHERE scope IS NOT NULL
+                    ON CONFLICT (scope) DO UPDATE SET version = version + 1;"""
+
+def migration_view_cache_versions(cursor):
+    # cached pages are keyed on these, triggers bump them in the same transaction as the write so every process sees it
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS cache_versions(
+        scope TEXT PRIMARY KEY,
+        version INTEGER NOT NULL
+        ) WITHOUT ROWID
+        ''')
+    for table, scopes in CACHE_VERSION_TRIGGERS:
+        for event, rows in [('INSERT', ['NEW']), ('UPDATE', ['OLD', 'NEW']), ('DELETE', ['OLD'])]:
+            bumps = '\n                    '.join(bump_cache_version_sql(scope.replace('ROW', row)) for row in rows for scope in scopes)
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS cache_{table}_{event.lower()} AFTER {event} ON {table}
+                BEGIN
+                    {bumps}
+                END
+            ''')
+    # names show on other people's pages, so a rename bumps every class the account is in
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS cache_accounts_update AFTER UPDATE OF username, name ON accounts
+        BEGIN
+            INSERT INTO cache_versions (scope, version) VALUES (NEW.role || ':' || NEW.user_id, 1)
+                ON CONFLICT (scope) DO UPDATE SET version = version + 1;
+            INSERT INTO cache_versions (scope, version)
+                SELECT 'class:' || class_id, 1 FROM classes_students WHERE NEW.role = 'student' AND student_id = NEW.user_id
+                ON CONFLICT (scope) DO UPDATE SET version = version + 1;
+            INSERT INTO cache_versions (scope, version)
+                SELECT 'class:' || class_id, 1 FROM classes WHERE NEW.role = 'teacher' AND teacher_id = NEW.user_id
+                ON CONFLICT (scope) DO UPDATE SET version = version + 1;
+        END
+    ''')
+
+def migration_fix_renamed_teachers(cursor):
+    # migration 8 used to rename clashing teachers to name_teacherN, which is_valid rejects so they couldn't log in
+    cursor.execute("SELECT user_id, username FROM accounts WHERE role = 'teacher' AND username LIKE '%\\_teacher' || user_id ESCAPE '\\'")
+    for user_id, username in cursor.fetchall():
+        new_username = unused_username(cursor, username[:-len(f'_teacher{user_id}')] + f'-teacher{user_id}')
+        app.logger.warning(f'Teacher:{user_id} username {username} renamed to {new_username}')
+        cursor.execute("UPDATE accounts SET username = ? WHERE role = 'teacher' AND user_id = ?", (new_username, user_id))
+
+# (version, name, function) - append new migrations to the end, never renumber applied ones
+MIGRATIONS = [
+    (1, 'add secondary indexes', migration_add_indexes),
+    (2, 'store session times as epochs with a duration column', migration_session_epochs),
+    (3, 'add daily study totals rollup', migration_daily_totals),
+    (4, 'track teacher study time edits as an adjustment', migration_study_time_adjustment),
+    (5, 'add server side active timers', migration_active_timers),
+    (6, 'allocate join codes for existing classes', migration_allocate_join_codes),
+    (7, 'assign outstanding teacher tasks to late joiners', migration_assign_missed_tasks),
+    (8, 'merge students and teachers into accounts', migration_unified_accounts),
+    (9, 'add server side session table', migration_web_sessions),
+    (10, 'add page cache versions', migration_view_cache_versions),
+    (11, 'give teachers renamed by migration 8 a valid username', migration_fix_renamed_teachers),
+]
+
+def get_schema_version(cursor):
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return cursor.fetchone()[0]
+
+def migrate_db(conn):
+    """Applies any migrations newer than the version recorded in schema_version"""
+    cursor = conn.cursor()
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS schema_version(
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at DATETIME NOT NULL
+        )
+        ''')
+    conn.commit()
+    for version, name, migration in MIGRATIONS:
+        # BEGIN IMMEDIATE takes the write lock so two workers starting together can't both apply a migration
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            if version > get_schema_version(cursor):
+                migration(cursor)
+                cursor.execute("INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)", (version, name, datetime.now()))
+                app.logger.info(f'Applied migration {version}: {name}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
 def find_duplicate(cursor, username): 
-    cursor.execute("SELECT COUNT(*) FROM students WHERE username = ?", (username,))
-    student_count = cursor.fetchone()[0]
-    cursor.execute("SELECT COUNT(*) FROM teachers WHERE username = ?", (username,))
-    teacher_count = cursor.fetchone()[0]
-    if student_count > 0 or teacher_count > 0:
-        return True
-    
+    cursor.execute("SELECT 1 FROM accounts WHERE username = ?", (username,))
+    return cursor.fetchone() is not None
+
+def get_account(cursor, role, user_id):
+    # same columns as the old students/teachers rows so templates using user_data[n] still work
+    cursor.execute("SELECT user_id, username, password, name, mfa_secret FROM accounts WHERE role = ? AND user_id = ?", (role, user_id))
+    return cursor.fetchone()
+
+def create_account(cursor, role, username, password_hash, name):
+    # a new account's user_id is its account_id, which is always past any id either role has used
+    cursor.execute('''
+        INSERT INTO accounts (role, user_id, username, password, name)
+        VALUES (?, COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'accounts') + 1, 1), ?, ?, ?)
+    ''', (role, username, password_hash, name))
+
 def is_valid(text):
     text = str(text)
     return isinstance(text, str) and 0 < len(text) <= 255 and re.match(r"^[a-zA-Z0-9\s.,'-]+$", text)
@@ -140,41 +1051,35 @@ def san_input(user_input):
 def verify(auth='student'):
     if 'user_id' in session and 'csrf_token' in session:
         if auth == 'teacher':
-            if session['user_type'] == 'teacher':
-                return True
+            # student and teacher ids overlap, so a student must never pass a teacher check
+            return session['user_type'] == 'teacher' and bool(session['user_id'])
         if session['user_id']:
             return True
     return False
     
-def generate_join_code(class_id):
-    join_code = ''
-    for i in range(0, 6, 1):
-        join_code += str(random.randint(0,9))
-    conn = sqlite3.connect('study_app.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT join_code FROM classes")
-    existing_join_code = str(cursor.fetchall()) #kinda bad but works
-    while join_code in existing_join_code:
-        join_code = ''
-        for i in range(0, 6, 1):
-            join_code += str(random.randint(0,9))
-        
-    cursor.execute("UPDATE classes SET join_code = ? WHERE class_id = ?", (join_code, class_id))
-    conn.commit()
-    conn.close()
-    return join_code
+def allocate_join_code(cursor, class_id):
+    """Gives a class a new random join code, the UNIQUE index on join_code rejects collisions"""
+    for attempt in range(JOIN_CODE_ATTEMPTS):
+        # starts at 100000 so the code is always 6 digits, the column is an INTEGER and would drop a leading 0
+        join_code = random.randint(100000, 999999)
+        try:
+            cursor.execute("UPDATE classes SET join_code = ? WHERE class_id = ?", (join_code, class_id))
+            return join_code
+        except sqlite3.IntegrityError:
+            app.logger.info(f'Join code collision for class:{class_id}, attempt {attempt + 1}')
+    raise RuntimeError(f'Could not allocate a join code for class:{class_id}')
 
 def add_student(conn, cursor, student_id, class_id):
     cursor.execute("SELECT COUNT(*) FROM classes_students WHERE (class_id, student_id) = (?, ?)", (class_id, student_id))
     class_duplicate = cursor.fetchone()[0]
     if class_duplicate > 0:
-        conn.close()
         flash("Already in class", 'error')
         return redirect('/dashboard')
     else:
         cursor.execute("INSERT INTO classes_students (class_id, student_id, total_study_time) VALUES (?, ?, ?)", (class_id, student_id, 0))
+        # a late joiner gets the class's tasks that aren't past due yet
+        assign_teacher_tasks(cursor, class_id, student_id=student_id, outstanding_only=True)
         conn.commit()
-        conn.close()
         if session['user_type'] == 'teacher':
             app.logger.info(f'Student:{student_id} added to class:{class_id}')
             flash('Student added successfully', 'success')
@@ -182,13 +1087,84 @@ def add_student(conn, cursor, student_id, class_id):
             flash('Class joined successfully', 'success')
         return redirect('/dashboard')
 
+def assign_teacher_tasks(cursor, class_id=None, teacher_task_id=None, student_id=None, outstanding_only=False, created_at=None):
+    """Creates any missing student_tasks rows for teacher tasks in one INSERT ... SELECT"""
+    filters = ""
+    params = [created_at or datetime.now()]
+    if class_id is not None:
+        filters += " AND t.class_id = ?"
+        params.append(class_id)
+    if teacher_task_id is not None:
+        filters += " AND t.teacher_task_id = ?"
+        params.append(teacher_task_id)
+    if student_id is not None:
+        filters += " AND cs.student_id = ?"
+        params.append(student_id)
+    if outstanding_only:
+        filters += " AND (t.due_date IS NULL OR t.due_date >= DATE('now', 'localtime'))"
+    cursor.execute(f'''
+        INSERT INTO student_tasks (teacher_task_id, student_id, created_at)
+        SELECT t.teacher_task_id, cs.student_id, ?
+        FROM teacher_tasks t
+        JOIN classes_students cs ON cs.class_id = t.class_id
+        WHERE NOT EXISTS (
+            SELECT 1 FROM student_tasks st
+            WHERE st.teacher_task_id = t.teacher_task_id AND st.student_id = cs.student_id
+        )
+        {filters}
+    ''', params)
+    return cursor.rowcount
+
+def parse_roster(text='', upload=None):
+    """Usernames from a pasted list and/or an uploaded CSV (first column), in order with duplicates removed"""
+    # usernames can't contain spaces so any whitespace, comma or semicolon separates them
+    usernames = re.split(r'[\s,;]+', text or '')
+    if upload and upload.filename:
+        rows = [row for row in csv.reader(io.StringIO(upload.read().decode('utf-8-sig', errors='replace'))) if row]
+        # a header row is allowed in the csv
+        if rows and rows[0][0].strip().lower() == 'username':
+            rows = rows[1:]
+        usernames += [row[0] for row in rows]
+    return list(dict.fromkeys(username.strip() for username in usernames if username.strip()))
+
+def bulk_add_students(cursor, class_id, usernames):
+    """Adds every known student in usernames to the class, returns [(username, result)] in the same order"""
+    valid = [username for username in usernames if is_valid(username)]
+    student_ids = {}
+    for i in range(0, len(valid), SQL_VARIABLE_CHUNK):
+        chunk = valid[i:i + SQL_VARIABLE_CHUNK]
+        placeholders = ','.join('?' * len(chunk))
+        cursor.execute(f"SELECT username, student_id FROM students WHERE username IN ({placeholders})", chunk)
+        student_ids.update(cursor.fetchall())
+    cursor.execute("SELECT student_id FROM classes_students WHERE class_id = ?", (class_id,))
+    members = {row[0] for row in cursor.fetchall()}
+
+    results = []
+    new_members = []
+    for username in usernames:
+        student_id = student_ids.get(username)
+        if not is_valid(username):
+            results.append((username, 'Invalid username'))
+        elif student_id is None:
+            results.append((username, 'Student not found'))
+        elif student_id in members:
+            results.append((username, 'Already in class'))
+        else:
+            results.append((username, 'Added'))
+            new_members.append((class_id, student_id))
+            members.add(student_id)
+    # OR IGNORE covers a student joining by code between the SELECT and here
+    cursor.executemany("INSERT OR IGNORE INTO classes_students (class_id, student_id, total_study_time) VALUES (?, ?, 0)", new_members)
+    if new_members:
+        assign_teacher_tasks(cursor, class_id, outstanding_only=True)
+    return results
+
 def auth_teacher(teacher_id, class_id):
     if get_class(class_id):
-        conn = sqlite3.connect('study_app.db')
+        conn = get_db()
         cursor = conn.cursor()
         cursor.execute("SELECT teacher_id FROM classes WHERE class_id = ?", (class_id,))
         required_teacher_id = cursor.fetchone()[0]
-        conn.close()
         if teacher_id == required_teacher_id:
             return True
         else:
@@ -196,73 +1172,78 @@ def auth_teacher(teacher_id, class_id):
     else:
         return False
     
+def get_student_names(cursor, student_ids):
+    """Returns the request's student id -> name map, fetching any missing ids in one query"""
+    names = g.setdefault('student_names', {})
+    missing = list({int(student_id) for student_id in student_ids} - names.keys())
+    if missing:
+        placeholders = ','.join('?' * len(missing))
+        cursor.execute(f"SELECT student_id, name FROM students WHERE student_id IN ({placeholders})", missing)
+        names.update(cursor.fetchall())
+    return names
+
+# positions match the old query columns so templates indexing task[n] keep working
+TeacherTask = namedtuple('TeacherTask', [
+    'teacher_task_id', 'class_id', 'class_name', 'colour', 'created_at', 'due_date', 'duration', 'description',
+    'completed_students', 'incomplete_students', 'total_students', 'completed_count', 'incomplete_count',
+    'completion'  # student_id -> True/False, completed students first
+])
+StudentTask = namedtuple('StudentTask', [
+    'student_task_id', 'class_id', 'class_name', 'colour', 'created_at', 'due_date', 'duration', 'description',
+    'completed', 'completed_at', 'teacher_task_id'
+])
+
+def get_teacher_tasks(cursor, teacher_id, class_id=None):
+    class_filter = "AND t.class_id = ?" if class_id else ""
+    params = (teacher_id, class_id) if class_id else (teacher_id,)
+    cursor.execute(f'''
+        SELECT 
+            t.teacher_task_id,
+            t.class_id,
+            c.name AS class_name,
+            c.colour,
+            t.created_at,
+            t.due_date,
+            t.duration,
+            t.description
+        FROM teacher_tasks t
+        JOIN classes c ON t.class_id = c.class_id
+        WHERE c.teacher_id = ?
+        {class_filter}
+        ORDER BY t.created_at DESC
+    ''', params)
+    task_rows = cursor.fetchall()
+
+    # one pass over every assignment builds each task's completion map, names go into the request's name map
+    cursor.execute(f'''
+        SELECT st.teacher_task_id, st.student_id, st.completed, s.name
+        FROM teacher_tasks t
+        JOIN classes c ON t.class_id = c.class_id
+        JOIN student_tasks st ON t.teacher_task_id = st.teacher_task_id
+        LEFT JOIN students s ON st.student_id = s.student_id
+        WHERE c.teacher_id = ?
+        {class_filter}
+        ORDER BY st.completed DESC, s.name
+    ''', params)
+    completion = {}
+    names = g.setdefault('student_names', {})
+    for teacher_task_id, student_id, completed, name in cursor.fetchall():
+        completion.setdefault(teacher_task_id, {})[student_id] = completed == 1
+        if name is not None:
+            names[student_id] = name
+
+    task_data = []
+    for row in task_rows:
+        students = completion.get(row[0], {})
+        completed_students = frozenset(student_id for student_id, done in students.items() if done)
+        incomplete_students = frozenset(students.keys() - completed_students)
+        task_data.append(TeacherTask(*row, completed_students, incomplete_students, len(students),
+                                     len(completed_students), len(incomplete_students), students))
+    return task_data
+
 def get_tasks(cursor, user_data, class_id=None):
     if session['user_type'] == 'teacher': #meaning its a teacher
-        if not class_id:
-            cursor.execute('''
-                SELECT 
-                    t.teacher_task_id,
-                    t.class_id,
-                    c.name AS class_name,
-                    c.colour,
-                    t.created_at,
-                    t.due_date,
-                    t.duration,
-                    t.description,
-                    GROUP_CONCAT(
-                        CASE WHEN st.completed = 1 
-                        THEN st.student_id 
-                        END
-                    ) AS completed_student_ids,
-                    GROUP_CONCAT(
-                        CASE WHEN st.completed = 0 OR st.completed IS NULL 
-                        THEN st.student_id 
-                        END
-                    ) AS incomplete_student_ids,
-                    COUNT(DISTINCT st.student_id) AS total_students,
-                    COUNT(DISTINCT CASE WHEN st.completed = 1 THEN st.student_id END) AS completed_count,
-                    COUNT(DISTINCT CASE WHEN st.completed = 0 OR st.completed IS NULL THEN st.student_id END) AS incomplete_count
-                FROM teacher_tasks t
-                JOIN classes c ON t.class_id = c.class_id
-                LEFT JOIN student_tasks st ON t.teacher_task_id = st.teacher_task_id
-                WHERE c.teacher_id = ?
-                GROUP BY t.teacher_task_id, t.class_id, c.name, c.colour, t.created_at, t.due_date, t.duration, t.description
-                ORDER BY t.created_at DESC
-            ''', (user_data[0],))    
-        else:
-            cursor.execute('''
-                SELECT 
-                    t.teacher_task_id,
-                    t.class_id,
-                    c.name AS class_name,
-                    c.colour,
-                    t.created_at,
-                    t.due_date,
-                    t.duration,
-                    t.description,
-                    GROUP_CONCAT(
-                        CASE WHEN st.completed = 1 
-                        THEN st.student_id 
-                        END
-                    ) AS completed_student_ids,
-                    GROUP_CONCAT(
-                        CASE WHEN st.completed = 0 OR st.completed IS NULL 
-                        THEN st.student_id 
-                        END
-                    ) AS incomplete_student_ids,
-                    COUNT(DISTINCT st.student_id) AS total_students,
-                    COUNT(DISTINCT CASE WHEN st.completed = 1 THEN st.student_id END) AS completed_count,
-                    COUNT(DISTINCT CASE WHEN st.completed = 0 OR st.completed IS NULL THEN st.student_id END) AS incomplete_count
-                FROM teacher_tasks t
-                JOIN classes c ON t.class_id = c.class_id
-                LEFT JOIN student_tasks st ON t.teacher_task_id = st.teacher_task_id
-                WHERE c.teacher_id = ?
-                AND t.class_id = ?
-                GROUP BY t.teacher_task_id, t.class_id, c.name, c.colour, t.created_at, t.due_date, t.duration, t.description
-                ORDER BY t.created_at DESC
-            ''', (user_data[0], class_id))
-        task_data = cursor.fetchall()
-        return task_data
+        return get_teacher_tasks(cursor, user_data[0], class_id)
     else: #its a student
         cursor.execute('''
             SELECT 
@@ -283,25 +1264,123 @@ def get_tasks(cursor, user_data, class_id=None):
             WHERE st.student_id = ?
             ORDER BY st.completed, st.created_at DESC
         ''', (user_data[0],))
-        task_data = cursor.fetchall()
-        #print(task_data)
+        task_data = [StudentTask._make(row) for row in cursor.fetchall()]
     return task_data
 
     
 def get_class(class_id):
-    conn = sqlite3.connect('study_app.db')
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM classes WHERE class_id = ?", (class_id,))
     class_entity = cursor.fetchone()
-    conn.close()
     return class_entity
     
 def clear_mfa(id):
-    conn = sqlite3.connect('study_app.db')
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute("UPDATE teachers SET mfa_secret = ? WHERE teacher_id = ?", (None, id))
+    cursor.execute("UPDATE accounts SET mfa_secret = ? WHERE role = 'teacher' AND user_id = ?", (None, id))
     conn.commit()
-    conn.close()  
+
+mfa_qr_cache = {}
+mfa_qr_lock = threading.Lock()
+
+def mfa_qr_data_uri(uri):
+    """SVG data URI of an MFA provisioning QR code, kept for MFA_QR_TTL so reloading the setup page doesn't redraw it"""
+    now = time.monotonic()
+    with mfa_qr_lock:
+        cached = mfa_qr_cache.get(uri)
+        if cached and cached[0] > now:
+            return cached[1]
+    # drawn in memory so nothing touches the filesystem (read only on vercel) and users can't overwrite each other's code
+    buffer = io.BytesIO()
+    qrcode.make(uri, image_factory=qrcode.image.svg.SvgPathFillImage).save(buffer)
+    data_uri = 'data:image/svg+xml;base64,' + base64.b64encode(buffer.getvalue()).decode()
+    with mfa_qr_lock:
+        for key in [key for key, (expires, _) in mfa_qr_cache.items() if expires <= now]:
+            del mfa_qr_cache[key]
+        if len(mfa_qr_cache) >= MFA_QR_CACHE_SIZE:
+            del mfa_qr_cache[next(iter(mfa_qr_cache))]
+        mfa_qr_cache[uri] = (now + MFA_QR_TTL, data_uri)
+    return data_uri
+
+class ViewCache:
+    """LRU of rendered page bodies bounded by their total size, entries also expire after ttl seconds"""
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = {}  # key -> (expires, versions, size, value), least recently used first
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, versions):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic() or entry[1] != versions:
+                self.size -= entry[2]
+                return None
+            self.entries[key] = entry
+            return entry[3]
+
+    def put(self, key, versions, size, value):
+        # one page over half the budget would push everything else out
+        if size > self.max_bytes // 2:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            while self.entries and self.size + size > self.max_bytes:
+                self.size -= self.entries.pop(next(iter(self.entries)))[2]
+            self.entries[key] = (time.monotonic() + self.ttl, versions, size, value)
+            self.size += size
+
+def get_view_cache():
+    cache = app.extensions.get('view_cache')
+    if cache is None:
+        cache = ViewCache(app.config['VIEW_CACHE_MAX_BYTES'], app.config['VIEW_CACHE_TTL'])
+        app.extensions['view_cache'] = cache
+    return cache
+
+def view_versions(cursor, user_type, user_id, class_id=None):
+    """(scope, version) pairs a page depends on, the user and their classes or just the class being viewed"""
+    if class_id is not None:
+        scopes = "SELECT 'teacher:' || ? AS scope UNION ALL SELECT 'class:' || ?"
+        params = (user_id, class_id)
+    elif user_type == 'teacher':
+        scopes = "SELECT 'teacher:' || ? AS scope UNION ALL SELECT 'class:' || class_id FROM classes WHERE teacher_id = ?"
+        params = (user_id, user_id)
+    else:
+        scopes = "SELECT 'student:' || ? AS scope UNION ALL SELECT 'class:' || class_id FROM classes_students WHERE student_id = ?"
+        params = (user_id, user_id)
+    cursor.execute(f'''
+        SELECT s.scope, COALESCE(v.version, 0) FROM ({scopes}) s
+        LEFT JOIN cache_versions v ON v.scope = s.scope
+        ORDER BY s.scope
+    ''', params)
+    return tuple(cursor.fetchall())
+
+def render_cached(template_name, key, versions, compute):
+    """Renders template_name with the context from compute(), reusing the rendered body block while versions match
+
+    The layout around it (flashed messages, the running timer, the current page) is still rendered every request.
+    """
+    if app.config['VIEW_CACHE_MAX_BYTES'] <= 0:
+        return render_template(template_name, **compute())
+    cache = get_view_cache()
+    cached = cache.get((template_name, key), versions)
+    if cached is None:
+        context = compute()
+        started = time.perf_counter()
+        template = app.jinja_env.get_template(template_name)
+        app.update_template_context(context)
+        body = Markup(''.join(template.blocks['body'](template.new_context(context))))
+        g.render_time = g.get('render_time', 0.0) + time.perf_counter() - started
+        cached = (body, {name: context[name] for name in LAYOUT_CONTEXT if name in context})
+        cache.put((template_name, key), versions, len(body), cached)
+    body, layout_context = cached
+    return render_template('layouts/layout_cached.html', body=body, **layout_context)
 
 def convertToSeconds(timeString):
     #timeString is in the format hour:minutes:seconds with each taking up 2 length (if that makes sense)
@@ -311,13 +1390,13 @@ def convertToSeconds(timeString):
     return total
     
 def updateTotalStudyTime(cursor, student_id, class_id, time):
-    cursor.execute('SELECT total_study_time FROM classes_students WHERE student_id = ? AND class_id = ?', (student_id, class_id))
-    total_study_time = cursor.fetchone()[0]
-    #print(time)
-    new_total = total_study_time + time
-    if new_total < 0:
-        new_total = 0
-    cursor.execute('UPDATE classes_students SET total_study_time = ? WHERE student_id = ? AND class_id = ?', (new_total, student_id, class_id))
+    # one UPDATE so concurrent sessions can't overwrite each other's totals, anything clamped off at 0 goes into the adjustment
+    cursor.execute('''
+        UPDATE classes_students
+        SET study_time_adjustment = study_time_adjustment + MAX(-(total_study_time + ?), 0),
+            total_study_time = MAX(total_study_time + ?, 0)
+        WHERE student_id = ? AND class_id = ?
+    ''', (time, time, student_id, class_id))
     
 def is_valid_time(time): # will need work
     #print(time)
@@ -393,67 +1472,390 @@ def random_month_sessions(cursor, user_id):
             # Choose random description
             description = random.choice(descriptions)
             
-            # Insert the session
-            cursor.execute('''
-                INSERT INTO study_sessions (class_id, student_id, start_time, end_time, description)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (class_id, user_id, start_time, end_time, description))
-            
-            # Update the total study time for this class
-            cursor.execute('''
-                UPDATE classes_students 
-                SET total_study_time = total_study_time + ?
-                WHERE student_id = ? AND class_id = ?
-            ''', (duration_seconds, user_id, class_id))
+            # Insert the session, this also adds it to the class total
+            insert_study_session(cursor, class_id, user_id, start_time, end_time, description)
     
     print(f"Generated random sessions for user {user_id} over the past 30 days")
     
 def check_password(password):
     return bool(re.search(r'(?=.*[A-Z])(?=.*[a-z])(?=.*\d)', password) and len(password) >= 8)
 
+def get_active_timer(cursor, student_id):
+    # (class_id, started_ts) or None, elapsed time is worked out from started_ts so nothing is written while it runs
+    cursor.execute("SELECT class_id, started_ts FROM active_timers WHERE student_id = ?", (student_id,))
+    return cursor.fetchone()
+
+def to_epoch(date_time):
+    # naive datetimes are local time, same as the text timestamps
+    return int(date_time.timestamp())
+
+def insert_study_session(cursor, class_id, student_id, start_time, end_time, description):
+    start_ts = to_epoch(start_time)
+    end_ts = to_epoch(end_time)
+    duration_seconds = max(end_ts - start_ts, 0)
+    cursor.execute('''
+        INSERT INTO study_sessions (class_id, student_id, start_time, end_time, start_ts, end_ts, duration_seconds, description)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (class_id, student_id, start_time, end_time, start_ts, end_ts, duration_seconds, description))
+    add_daily_total(cursor, student_id, class_id, start_ts, duration_seconds)
+    updateTotalStudyTime(cursor, student_id, class_id, duration_seconds)
+    return duration_seconds
+
+def add_daily_total(cursor, student_id, class_id, start_ts, seconds):
+    # called in the same transaction as every change to study_sessions so the rollup never drifts
+    cursor.execute('''
+        INSERT INTO daily_study_totals (student_id, class_id, day, seconds)
+        VALUES (?, ?, DATE(?, 'unixepoch', 'localtime'), ?)
+        ON CONFLICT (student_id, day, class_id) DO UPDATE SET seconds = seconds + excluded.seconds
+    ''', (student_id, class_id, start_ts, seconds))
+
+def rebuild_daily_totals(cursor):
+    cursor.execute("DELETE FROM daily_study_totals")
+    cursor.execute('''
+        INSERT INTO daily_study_totals (student_id, class_id, day, seconds)
+        SELECT student_id, class_id, DATE(start_ts, 'unixepoch', 'localtime') AS day, SUM(duration_seconds)
+        FROM study_sessions
+        GROUP BY student_id, class_id, day
+    ''')
+
+def csv_line(row):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(row)
+    return buffer.getvalue()
+
+def get_session_stats(cursor, class_id):
+    """Session count, total and average duration in seconds for each student in a class"""
+    cursor.execute('''
+        SELECT student_id,
+               COUNT(*) AS session_count,
+               SUM(duration_seconds) AS total_seconds
+        FROM study_sessions
+        WHERE class_id = ?
+        GROUP BY student_id
+    ''', (class_id,))
+    stats = {}
+    for student_id, session_count, total_seconds in cursor.fetchall():
+        total_seconds = total_seconds or 0
+        stats[student_id] = {'total': session_count, 'total_seconds': total_seconds, 'average': total_seconds / session_count}
+    return stats
+
 def get_daily_totals(cursor, user_id, days):
-    cutoff_date = (datetime.now().date() - timedelta(days=days)).strftime("%Y-%m-%d")
+    today = datetime.now().date()
+    cutoff_date = (today - timedelta(days=days)).strftime("%Y-%m-%d")
 
     cursor.execute("""
-        SELECT DATE(start_time) as session_date,
-               SUM(
-                   CAST(
-                       (strftime('%s', end_time) - strftime('%s', start_time)) 
-                       AS INTEGER
-                   )
-               ) as total_seconds
-        FROM study_sessions
+        SELECT day, SUM(seconds)
+        FROM daily_study_totals
         WHERE student_id = ?
-        AND DATE(start_time) >= ?
-        GROUP BY session_date
-        ORDER BY session_date DESC
+        AND day >= ?
+        GROUP BY day
     """, (user_id, cutoff_date))
 
-    results = cursor.fetchall()
-
     # Fill in days with no study time as 0
-    daily_totals = {}
-    for date_str, total_seconds in results:
-        daily_totals[date_str] = total_seconds or 0
+    daily_totals = dict(cursor.fetchall())
 
     output = []
     for day_offset in range(days + 1):  # today + back 'days'
-        target_date = (datetime.now().date() - timedelta(days=day_offset)).strftime("%Y-%m-%d")
+        target_date = (today - timedelta(days=day_offset)).strftime("%Y-%m-%d")
         output.append((target_date, daily_totals.get(target_date, 0)))
-
-    print(output)
     return output
 
+@app.cli.command('rebuild-daily-totals')
+def rebuild_daily_totals_command():
+    """Recompute the daily_study_totals rollup from study_sessions"""
+    conn = connect_db()
+    conn.execute("BEGIN IMMEDIATE")
+    cursor = conn.cursor()
+    # the rollup has no cache triggers, bump every student whose chart could change so cached dashboards are redrawn
+    cursor.execute('''
+        INSERT INTO cache_versions (scope, version)
+        SELECT 'student:' || student_id, 1 FROM (SELECT student_id FROM daily_study_totals UNION SELECT student_id FROM study_sessions)
+        WHERE true  -- sqlite needs a WHERE before ON CONFLICT in an INSERT ... SELECT
+        ON CONFLICT (scope) DO UPDATE SET version = version + 1
+    ''')
+    rebuild_daily_totals(cursor)
+    conn.commit()
+    conn.close()
+    click.echo('Daily study totals rebuilt')
+
+def find_total_drift(cursor):
+    """Rows whose total_study_time doesn't match their sessions plus adjustment, as (class_id, student_id, stored, expected)"""
+    cursor.execute('''
+        SELECT cs.class_id, cs.student_id, cs.total_study_time,
+               MAX(COALESCE(totals.seconds, 0) + cs.study_time_adjustment, 0) AS expected
+        FROM classes_students cs
+        LEFT JOIN (
+            SELECT class_id, student_id, SUM(duration_seconds) AS seconds
+            FROM study_sessions
+            GROUP BY class_id, student_id
+        ) totals ON totals.class_id = cs.class_id AND totals.student_id = cs.student_id
+        WHERE cs.total_study_time != expected
+    ''')
+    return cursor.fetchall()
+
+@app.cli.command('reconcile-study-time')
+@click.option('--fix', is_flag=True, help='Overwrite drifted totals with the recomputed value')
+def reconcile_study_time_command(fix):
+    """Check classes_students.total_study_time against the session log"""
+    conn = connect_db()
+    conn.execute("BEGIN IMMEDIATE")
+    cursor = conn.cursor()
+    drift = find_total_drift(cursor)
+    for class_id, student_id, stored, expected in drift:
+        click.echo(f'class:{class_id} student:{student_id} stored {stored} expected {expected}')
+    if fix and drift:
+        cursor.executemany("UPDATE classes_students SET total_study_time = ? WHERE class_id = ? AND student_id = ?",
+                           [(expected, class_id, student_id) for class_id, student_id, stored, expected in drift])
+    conn.commit()
+    conn.close()
+    if fix:
+        click.echo(f'{len(drift)} totals fixed')
+    else:
+        click.echo(f'{len(drift)} totals out of sync')
+
+
+class SizedTimedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Rotates on size like RotatingFileHandler and also once every interval seconds"""
+    def __init__(self, filename, max_bytes, interval, backup_count):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        self.interval = interval
+        self.rollover_at = time.time() + interval
+
+    def shouldRollover(self, record):
+        return time.time() >= self.rollover_at or super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = time.time() + self.interval
+
+class JsonFormatter(logging.Formatter):
+    FIELDS = ['route', 'method', 'status', 'latency_ms', 'sql_queries', 'sql_ms', 'user_type', 'user_id', 'class_id',
+              'sql', 'parameters', 'duration_ms', 'plan', 'full_scan']
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class RequestContextFilter(logging.Filter):
+    """Tags records made during a request with the route, user and class, has to run on the request thread"""
+    def filter(self, record):
+        if has_request_context():
+            record.route = request.url_rule.rule if request.url_rule else request.path
+            record.method = request.method
+            record.user_type = session.get('user_type')
+            record.user_id = session.get('user_id')
+            class_id = (request.view_args or {}).get('class_id') or request.args.get('class_id')
+            # only read the form if the view already parsed it, parsing it here could raise inside a log call
+            if class_id is None and 'form' in request.__dict__:
+                class_id = request.form.get('class_id')
+            record.class_id = class_id
+        return True
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records rather than blocking or raising once the writer falls behind"""
+    dropped = 0
+
+    def prepare(self, record):
+        # resolve the message and traceback now since args may change after the call, formatting is left to the writer
+        # (this is the only handler so the record is changed in place rather than copied)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class LogQueueListener(logging.handlers.QueueListener):
+    def stop(self):
+        # the queue may be full at shutdown so give the writer time to make room,
+        # but a writer thread that died or is stuck must not hang the exit
+        if self._thread is None:
+            return
+        try:
+            self.queue.put(self._sentinel, timeout=LOG_SHUTDOWN_TIMEOUT)
+            self._thread.join(LOG_SHUTDOWN_TIMEOUT)
+        except queue.Full:
+            pass
+        self._thread = None
+
+def log_file_path(path):
+    """LOG_FILE for this process and the lock file held while writing it
+
+    Each process rotates its own handler, so two processes writing one file would rename it out from under each other.
+    {pid} in LOG_FILE gives every worker its own file, otherwise the first process takes the file and later ones
+    fall back to name.<pid>.log.
+    """
+    if '{pid}' in path:
+        return path.replace('{pid}', str(os.getpid())), None
+    if fcntl is None:
+        return path, None
+    lock = open(path + '.lock', 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return path, lock
+    except OSError:
+        lock.close()
+        root, ext = os.path.splitext(path)
+        return f'{root}.{os.getpid()}{ext}', None
+
+def configure_logging():
+    """Request threads only put records on a queue, one listener thread formats them and writes record.log"""
+    path, lock = log_file_path(app.config['LOG_FILE'])
+    file_handler = SizedTimedRotatingFileHandler(path, app.config['LOG_MAX_BYTES'],
+                                                 app.config['LOG_ROTATE_HOURS'] * 3600, app.config['LOG_BACKUP_COUNT'])
+    file_handler.lock_file = lock  # released when the process exits
+    file_handler.setFormatter(JsonFormatter())
+    queue_handler = DroppingQueueHandler(queue.Queue(app.config['LOG_QUEUE_SIZE']))
+    queue_handler.addFilter(RequestContextFilter())
+    listener = LogQueueListener(queue_handler.queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)  # flushes whatever is still queued on shutdown
+    logging.logProcesses = False  # nothing reads the pid or process name, skip looking them up for every record
+    logging.logMultiprocessing = False
+    logging.basicConfig(level=app.config['LOG_LEVEL'], handlers=[queue_handler])
+    if path != app.config['LOG_FILE'] and '{pid}' not in app.config['LOG_FILE']:
+        app.logger.warning(f"{app.config['LOG_FILE']} is in use by another process, logging to {path}")
+    return listener
+
+class Histogram:
+    """Prometheus style histogram with one series per endpoint"""
+    def __init__(self, name, description, buckets):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.series = {}  # endpoint -> [count per bucket, sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, endpoint, value):
+        with self.lock:
+            series = self.series.setdefault(endpoint, [[0] * (len(self.buckets) + 1), 0, 0])
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for endpoint, (counts, total, count) in sorted(self.series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ['+Inf'], counts):
+                    cumulative += bucket_count
+                    lines.append(f'{self.name}_bucket{{endpoint="{endpoint}",le="{bound}"}} {cumulative}')
+                lines.append(f'{self.name}_sum{{endpoint="{endpoint}"}} {total}')
+                lines.append(f'{self.name}_count{{endpoint="{endpoint}"}} {count}')
+        return lines
+
+REQUEST_METRICS = {
+    'duration': Histogram('edura_request_duration_seconds', 'Time from the start of the request to the response', LATENCY_BUCKETS),
+    'sql_queries': Histogram('edura_request_sql_queries', 'SQL statements run per request', QUERY_COUNT_BUCKETS),
+    'sql_time': Histogram('edura_request_sql_duration_seconds', 'Time spent in sqlite per request', LATENCY_BUCKETS),
+    'render_time': Histogram('edura_request_render_duration_seconds', 'Time spent rendering templates per request', LATENCY_BUCKETS),
+}
 
 log = logging.getLogger("werkzeug")
 log.setLevel(logging.ERROR)
-logging.basicConfig(filename='record.log', level=logging.DEBUG, format='%(asctime)s %(levelname)s %(name)s %(threadName)s : %(message)s')
-limiter = Limiter(get_remote_address, app=app, default_limits=["200 per minute"])
+log_listener = configure_logging()
+if app.config['SESSION_BACKEND'] == 'sqlite':
+    app.session_interface = SqliteSessionInterface(app.config['SESSION_CACHE_SIZE'])
+
+def check_ratelimit_strategy():
+    """Falls back to fixed-window if the installed limits or the sqlite storage can't do RATELIMIT_STRATEGY"""
+    # Flask-Limiter raises on an unknown strategy and the app wouldn't start, e.g. elastic expiry is gone in limits 5
+    available = set(LIMIT_STRATEGIES)
+    if app.config['RATELIMIT_STORAGE_URI'].startswith('sqlite:'):
+        available &= SqliteLimiterStorage.STRATEGIES
+    strategy = app.config['RATELIMIT_STRATEGY']
+    if strategy not in available:
+        app.logger.warning(f"Rate limit strategy {strategy} isn't available with limits {limits.__version__} and "
+                           f"{app.config['RATELIMIT_STORAGE_URI']} (choose from {', '.join(sorted(available))}), using fixed-window")
+        app.config['RATELIMIT_STRATEGY'] = 'fixed-window'
+
+check_ratelimit_strategy()
+limiter = Limiter(rate_limit_key, app=app, default_limits=["200 per minute"])
+
+@limiter.request_filter
+def rate_limit_exempt():
+    return request.endpoint in RATE_LIMIT_EXEMPT_ENDPOINTS
+
 init_db()
 
+def regenerate_session():
+    # cookie sessions carry their data in the cookie itself, only a server side id can be fixed by an attacker
+    if isinstance(session._get_current_object(), ServerSession):
+        session.regenerate()
+
 @app.before_request
 def make_session_permanent():
-    session.permanent = True
+    # assigning marks the session modified, only do it once so unchanged sessions aren't written back
+    if not session.permanent:
+        session.permanent = True
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@before_render_template.connect_via(app)
+def start_render_timer(sender, template, context, **extra):
+    g.render_started = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def stop_render_timer(sender, template, context, **extra):
+    # includes any SQL run by filters while rendering, compare with the sql timing to tell the two apart
+    if 'render_started' in g:
+        g.render_time = g.get('render_time', 0.0) + time.perf_counter() - g.pop('render_started')
+
+@app.teardown_request
+def log_slow_queries(exception):
+    for statement in g.pop('slow_queries', []):
+        log_slow_query(statement)
+
+@app.after_request
+def log_request(response):
+    if request.endpoint not in ('static', 'metrics') and 'request_started' in g:
+        elapsed = time.perf_counter() - g.request_started
+        extra = {'status': response.status_code, 'latency_ms': round(elapsed * 1000, 2)}
+        if instrumentation_enabled():
+            sql_queries, sql_time, render_time = g.get('sql_queries', 0), g.get('sql_time', 0.0), g.get('render_time', 0.0)
+            extra.update(sql_queries=sql_queries, sql_ms=round(sql_time * 1000, 2))
+            if app.config['METRICS_ENABLED']:
+                endpoint = request.endpoint or 'unmatched'
+                REQUEST_METRICS['duration'].observe(endpoint, elapsed)
+                REQUEST_METRICS['sql_queries'].observe(endpoint, sql_queries)
+                REQUEST_METRICS['sql_time'].observe(endpoint, sql_time)
+                REQUEST_METRICS['render_time'].observe(endpoint, render_time)
+            if app.debug:
+                response.headers['Server-Timing'] = (f'app;dur={elapsed * 1000:.2f}, '
+                                                     f'sql;dur={sql_time * 1000:.2f};desc="{sql_queries} queries", '
+                                                     f'render;dur={render_time * 1000:.2f}')
+        app.logger.info(f'{request.method} {request.path} {response.status_code}', extra=extra)
+    return response
+
+@app.context_processor
+def inject_active_timer():
+    # the layout shows the stopwatch on every student page
+    if session.get('user_type') == 'student' and session.get('user_id'):
+        active_timer = get_active_timer(get_db().cursor(), session['user_id'])
+        if active_timer:
+            return {'active_timer': {'class_id': active_timer[0], 'started_ts': active_timer[1], 'now': int(time.time())}}
+    return {'active_timer': None}
 
 @app.template_filter('dateTimeFormat')
 def date_time_format_filter(date_time):
@@ -477,13 +1879,8 @@ def date_time_format_filter(date_time):
         return "Invalid date"
 
 @app.template_filter('duration')
-def duration_filter(start_time, end_time, type='readable'):
-    start_time = datetime.strptime(start_time, "%Y-%m-%d %H:%M:%S")
-    try:
-        end_time = datetime.strptime(end_time, "%Y-%m-%d %H:%M:%S.%f")
-    except:
-        end_time = datetime.strptime(end_time, "%Y-%m-%d %H:%M:%S")
-    total_seconds = (end_time - start_time).total_seconds()
+def duration_filter(total_seconds, type='readable'):
+    total_seconds = total_seconds or 0
     hours =  total_seconds / 3600
     minutes = round((hours - math.floor(hours)) * 60, 0)
     if type == 'seconds':
@@ -494,24 +1891,6 @@ def duration_filter(start_time, end_time, type='readable'):
         else:
             return f'{str(minutes).replace(".0", "")}m'
     
-@app.template_filter('sessionStats')
-def session_stats(session_data, student_id, stat):
-    if session_data:
-        total = 0
-        for session in session_data:
-            if session[2] == student_id:
-                total = total + 1
-        if stat == 'total':
-            return total
-        elif stat == 'average':
-            total_time = 0
-            for session in session_data:
-                if session[2] == student_id:
-                    total_time = total_time + int(duration_filter(session[3], session[4], 'seconds'))
-            if session == 0: 
-                return time_filter_filter(total_time/total)
-    return 0
-    
 @app.template_filter('timeFormat')
 def time_filter_filter(seconds):
     hours = int(seconds) / 3600
@@ -534,50 +1913,22 @@ def time_edit_filter(time):
     
 @app.template_filter('getStudentName')
 def get_student_name(student_id):
-    conn = sqlite3.connect('study_app.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT students.name FROM students WHERE student_id = ?", (student_id,))
-    student_name = cursor.fetchone()[0]
-    conn.close()
-    return student_name
+    # routes load names in bulk beforehand so this only queries for ids they didn't cover
+    cursor = get_db().cursor()
+    return get_student_names(cursor, [student_id]).get(int(student_id))
 
 @app.template_filter('getAllStudentIds')
-def get_all_student_ids(completed_ids, incomplete_ids):
-    """Combine completed and incomplete student IDs into a single list"""
-    all_ids = []
-    
-    # Add completed student IDs
-    if completed_ids and str(completed_ids).strip():
-        completed_list = str(completed_ids).split(',')
-        all_ids.extend([id.strip() for id in completed_list if id.strip()])
-    
-    # Add incomplete student IDs  
-    if incomplete_ids and str(incomplete_ids).strip():
-        incomplete_list = str(incomplete_ids).split(',')
-        all_ids.extend([id.strip() for id in incomplete_list if id.strip()])
-    
-    return all_ids
+def get_all_student_ids(completion):
+    """List the students assigned a task, completed ones first"""
+    return list(completion)
 
 @app.template_filter('getStudentStatus')
-def get_student_status(student_id, completed_ids, incomplete_ids):
+def get_student_status(student_id, completion):
     """Check if a student has completed the task or not"""
-    # Convert to strings and split
-    completed_list = []
-    if completed_ids and str(completed_ids).strip():
-        completed_list = [id.strip() for id in str(completed_ids).split(',') if id.strip()]
-    
-    incomplete_list = []
-    if incomplete_ids and str(incomplete_ids).strip():
-        incomplete_list = [id.strip() for id in str(incomplete_ids).split(',') if id.strip()]
-    
-    student_id_str = str(student_id).strip()
-    
-    if student_id_str in completed_list:
-        return 'completed'
-    elif student_id_str in incomplete_list:
-        return 'incomplete'
-    else:
+    completed = completion.get(student_id)
+    if completed is None:
         return 'unknown'
+    return 'completed' if completed else 'incomplete'
 
 @app.template_filter('colourDictionary')
 def colour_dictionary_filter(colour):
@@ -629,12 +1980,28 @@ def due_date_status_filter(due_date):
 def index():
     return render_template("index.html")
 
+@app.route('/health')
+def health():
+    """For load balancer and uptime checks, exempt from rate limits"""
+    get_db().execute("SELECT 1")
+    return {'status': 'ok'}
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus text format, only served when METRICS_ENABLED is set"""
+    if not app.config['METRICS_ENABLED']:
+        return render_template("404.html"), 404
+    lines = []
+    for histogram in REQUEST_METRICS.values():
+        lines.extend(histogram.render())
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
 
 @app.route('/generate_test_data')
 def generate_test_data():
     """One-time route to generate test data for the current user"""
     if verify():
-        conn = sqlite3.connect('study_app.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # Check if user already has sessions to avoid duplicates
@@ -648,7 +2015,6 @@ def generate_test_data():
             conn.commit()
             flash('Test data generated successfully!', 'success')
         
-        conn.close()
         return redirect('/dashboard')
     else:
         flash('Please login to continue', 'error')
@@ -656,6 +2022,7 @@ def generate_test_data():
 
 
 @app.route('/register', methods=['GET', 'POST'])
+@retry_on_locked
 def register():
     if request.method == "POST":
         username = request.form.get("username")
@@ -663,8 +2030,7 @@ def register():
         second_password = request.form.get("second_password")
         type = request.form.get("type")
         name = request.form.get("name")
-        hashed_password = generate_password_hash(password)
-        conn = sqlite3.connect('study_app.db')
+        conn = get_db()
         cursor = conn.cursor()
         if is_valid(username) and is_valid(password) and is_valid(name) and ' ' not in username and ' ' not in password:
             if type in TYPES:
@@ -675,19 +2041,22 @@ def register():
                 elif password != second_password:
                     flash('Passwords do not match', 'error')
                 else:
-                    if type == 'teacher':
-                        cursor.execute("INSERT INTO teachers (username, password, name) VALUES (?, ?, ?)", (username, hashed_password, name))
+                    # only hashed once everything else has passed, it's the expensive part of registering
+                    try:
+                        hashed_password = get_password_hasher().hash(password)
+                    except PasswordHasherBusy:
+                        flash('Lots of people are signing up right now, please try again in a moment', 'error')
+                        return render_template('register.html', types=TYPES), 503
+                    try:
+                        create_account(cursor, type, username, hashed_password, name)
                         conn.commit()
-                        conn.close()
-                        flash("Welcome! Your account has been successfully created.", 'success')
-                        
-                        return redirect('/login')
-                    else:
-                        cursor.execute("INSERT INTO students (username, password, name) VALUES (?, ?, ?)", (username, hashed_password, name))
-                        conn.commit()
-                        conn.close()
-                        flash("Welcome! Your account has been successfully created.", 'success')
-                        return redirect('/login')
+                    except sqlite3.IntegrityError:
+                        # someone took the username while the password was hashing
+                        conn.rollback()
+                        flash('Username already exists', 'error')
+                        return redirect('/register')
+                    flash("Welcome! Your account has been successfully created.", 'success')
+                    return redirect('/login')
             else:
                 flash('Invalid type', 'error')
                 return redirect('/register')
@@ -701,6 +2070,16 @@ def register():
         session['user_type'] = 'student'
     return render_template('register.html', types=TYPES)
 
+def rehash_password(conn, user_type, user_id, password_hash):
+    # hash settings have changed since this password was stored, upgrade it now that we have the plain text
+    try:
+        conn.execute("UPDATE accounts SET password = ? WHERE role = ? AND user_id = ?", (password_hash, user_type, user_id))
+        conn.commit()
+    except sqlite3.OperationalError as e:
+        # not worth failing the login over, it will be tried again next time
+        conn.rollback()
+        app.logger.warning(f'Could not rehash password for {user_type}:{user_id}: {e}')
+
 @app.route('/login', methods=['GET', 'POST'])
 @limiter.limit("20 per minute")
 def login():
@@ -708,28 +2087,27 @@ def login():
         username = request.form.get("username")
         password = request.form.get("password")
         if is_valid(username) and is_valid(password):
-            conn = sqlite3.connect('study_app.db')
+            conn = get_db()
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM students WHERE username = ?", (username,))
-            student_record = cursor.fetchone()
-            cursor.execute("SELECT * FROM teachers WHERE username = ?", (username,))
-            teacher_record = cursor.fetchone()
-            conn.close()
-            if student_record and check_password_hash(student_record[2], password): #user is array from database - password is in 3rd slot (begins from 0)
-                session['user_type'] = 'student'
-                session['pending_user'] = student_record[0]
-                if not student_record[4]:
-                    flash('Login successful', 'success')
-                    app.logger.info(f'Student:{student_record[0]} logged in')
-                    return redirect('/skip_mfa')
-                else:
-                    return redirect('/verify_mfa')
-            elif teacher_record and check_password_hash(teacher_record[2], password):
-                session['pending_user'] = teacher_record[0]
-                session['user_type'] = 'teacher'
-                if not teacher_record[4]:
+            cursor.execute("SELECT role, user_id, password, mfa_secret FROM accounts WHERE username = ?", (username,))
+            accounts = cursor.fetchall()  # fetch everything so the statement is finished before any rehash commits
+            account = accounts[0] if accounts else None
+            hasher = get_password_hasher()
+            try:
+                verified = account and hasher.verify(account[2], password)
+                if verified and hasher.needs_rehash(account[2]):
+                    rehash_password(conn, account[0], account[1], hasher.hash(password))
+            except PasswordHasherBusy:
+                flash('Lots of people are signing in right now, please try again in a moment', 'error')
+                return render_template('login.html'), 503
+            if verified:
+                user_type, user_id, _, mfa_secret = account
+                session['user_type'] = user_type
+                session['pending_user'] = user_id
+                regenerate_session()
+                if not mfa_secret:
                     flash('Login successful', 'success')
-                    app.logger.info(f'Teacher:{teacher_record[0]} logged in')
+                    app.logger.info(f'{user_type.title()}:{user_id} logged in')
                     return redirect('/skip_mfa')
                 else:
                     return redirect('/verify_mfa')
@@ -741,59 +2119,39 @@ def login():
 @app.route('/setup_mfa')
 def setup_mfa():
     user_id = session.get('user_id')
-    conn = sqlite3.connect('study_app.db')
+    conn = get_db()
     cursor = conn.cursor()
     
-    if session.get('user_type') == 'teacher':
-        cursor.execute("SELECT mfa_secret FROM teachers WHERE teacher_id = ?", (user_id,))
-    else:
-        cursor.execute("SELECT mfa_secret FROM students WHERE student_id = ?", (user_id,))
-
+    cursor.execute("SELECT mfa_secret FROM accounts WHERE role = ? AND user_id = ?", (session.get('user_type'), user_id))
     secret = cursor.fetchone()
     if secret:
         secret = secret[0]  # Extract actual value
 
     if not secret:
         secret = pyotp.random_base32()
-        if session['user_type'] == 'teacher':
-            cursor.execute("UPDATE teachers SET mfa_secret = ? WHERE teacher_id = ?", (secret, user_id))
-        else:
-            cursor.execute("UPDATE students SET mfa_secret = ? WHERE student_id = ?", (secret, user_id))
+        cursor.execute("UPDATE accounts SET mfa_secret = ? WHERE role = ? AND user_id = ?", (secret, session['user_type'], user_id))
         conn.commit()
 
-    conn.close()
 
     totp = pyotp.TOTP(secret)
     
     uri = totp.provisioning_uri(name=f'user{user_id}@edura.com', issuer_name="Edura")
-    qr = qrcode.make(uri)
-    qr_path = "static/images/qrcode.png"
-    qr.save(qr_path)
-
-    return render_template("setup-mfa.html", qr_path=qr_path)
+    response = make_response(render_template("setup-mfa.html", qr_code=mfa_qr_data_uri(uri)))
+    # the page embeds the secret, keep it out of browser and proxy caches
+    response.headers['Cache-Control'] = 'no-store'
+    return response
 
 @app.route('/skip_mfa')
 def skip_mfa():
     if session['pending_user']:
-        conn = sqlite3.connect('study_app.db')
+        conn = get_db()
         cursor = conn.cursor()
         user_id = session['pending_user']
         session['user_id'] = user_id
-        if session['user_type'] == 'student':
-            cursor.execute("SELECT * FROM students WHERE student_id = ?", (user_id,))
-            student_record = cursor.fetchone()
-            session['username'] = student_record[1]
-            session['start_study_time'] = None
-            session['study_class_id'] = None
-            session['timer_sec'] = 0
-            session['timer_min'] = 0
-            session['timer_hr'] = 0
-        else:
-            cursor.execute("SELECT * FROM teachers WHERE teacher_id = ?", (user_id,))
-            teacher_record = cursor.fetchone()
-            session['username'] = teacher_record[1]
+        session['username'] = get_account(cursor, session['user_type'], user_id)[1]
         session['csrf_token'] = str(uuid.uuid4())  # Add a CSRF token
         del session['pending_user']
+        regenerate_session()
         return redirect('/dashboard')
     else:
         flash('Please login to continue')
@@ -808,34 +2166,18 @@ def verify_mfa():
     if request.method == 'POST':
         # Retrieves the code from the text box
         otp_code = request.form['otp']
-        conn = sqlite3.connect('study_app.db')
+        conn = get_db()
         cursor = conn.cursor()
-        if session['user_type'] == 'teacher':
-            cursor.execute("SELECT mfa_secret FROM teachers WHERE teacher_id = ?", (user_id,))
-        else:
-            cursor.execute("SELECT mfa_secret FROM students WHERE student_id = ?", (user_id,))
-        secret = cursor.fetchone()[0]
+        account = get_account(cursor, session['user_type'], user_id)
+        secret = account[4]
         totp = pyotp.TOTP(secret)
         # Compares the input code to the database 
         if totp.verify(otp_code):
-            if session['user_type'] == 'student':
-                cursor.execute("SELECT * FROM students WHERE student_id = ?", (user_id,))
-                student_record = cursor.fetchone()
-                session['user_id'] = user_id
-                session['username'] = student_record[1]
-                session['start_study_time'] = None
-                session['study_class_id'] = None
-                session['timer_sec'] = 0
-                session['timer_min'] = 0
-                session['timer_hr'] = 0
-            else:
-                cursor.execute("SELECT * FROM teachers WHERE teacher_id = ?", (user_id,))
-                teacher_record = cursor.fetchone()
-                session['username'] = teacher_record[1]
-            
+            session['user_id'] = user_id
+            session['username'] = account[1]
             session['csrf_token'] = str(uuid.uuid4())  # Add a CSRF token
             del session['pending_user']
-            conn.close()
+            regenerate_session()
             flash('Login successful', 'success')
             return redirect('/dashboard')
         flash("Invalid 2FA code", "error")
@@ -845,164 +2187,230 @@ def verify_mfa():
 def dashboard():
     if verify():
         session['page'] = 'dashboard'
-        conn = sqlite3.connect('study_app.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         if session['user_type'] == 'student':
-            cursor.execute("SELECT * FROM students WHERE student_id = ?", (session['user_id'],))
-            student_data = cursor.fetchall()[0]
-            task_data = get_tasks(cursor, student_data)
-            cursor.execute('''
-            SELECT classes_students.total_study_time
-                FROM classes_students 
-                WHERE student_id = ? ORDER BY class_id DESC
-                ''', (session['user_id'],))
+            def dashboard_context():
+                student_data = get_account(cursor, 'student', session['user_id'])
+                task_data = get_tasks(cursor, student_data)
+                cursor.execute('''
+                SELECT classes_students.total_study_time
+                    FROM classes_students 
+                    WHERE student_id = ? ORDER BY class_id DESC
+                    ''', (session['user_id'],))
             
-            total_study_time = cursor.fetchall()
-            time_data = []
-            for i in total_study_time:
-                time_data.append(i[0])
+                total_study_time = cursor.fetchall()
+                time_data = []
+                for i in total_study_time:
+                    time_data.append(i[0])
             
-            cursor.execute('''
-            SELECT classes.class_id, classes.name, classes.colour, teachers.name
-                FROM classes 
-                JOIN classes_students ON classes.class_id = classes_students.class_id
-                JOIN students ON students.student_id = classes_students.student_id
-                JOIN teachers ON teachers.teacher_id = classes.teacher_id
-                WHERE students.student_id = ? ORDER BY classes.class_id DESC
-                ''', (session['user_id'],))
-            classes = cursor.fetchall()
+                cursor.execute('''
+                SELECT classes.class_id, classes.name, classes.colour, teachers.name
+                    FROM classes 
+                    JOIN classes_students ON classes.class_id = classes_students.class_id
+                    JOIN students ON students.student_id = classes_students.student_id
+                    JOIN teachers ON teachers.teacher_id = classes.teacher_id
+                    WHERE students.student_id = ? ORDER BY classes.class_id DESC
+                    ''', (session['user_id'],))
+                classes = cursor.fetchall()
             
-            cursor.execute("SELECT s.session_id, s.start_time, s.end_time, s.description, c.name, c.colour FROM study_sessions s JOIN classes c ON s.class_id = c.class_id WHERE s.student_id = ? ORDER BY s.end_time DESC LIMIT 5", (session['user_id'],))
-            sessions = cursor.fetchall()
+                cursor.execute("SELECT s.session_id, s.start_time, s.end_time, s.description, c.name, c.colour FROM study_sessions s JOIN classes c ON s.class_id = c.class_id WHERE s.student_id = ? ORDER BY s.end_ts DESC LIMIT 5", (session['user_id'],))
+                sessions = cursor.fetchall()
 
-            daily_totals = get_daily_totals(cursor, session['user_id'], 30)
-            graph_days = [day[0] for day in daily_totals]
-            graph_totals = [day[1] for day in daily_totals]
+                daily_totals = get_daily_totals(cursor, session['user_id'], 30)
+                graph_days = [day[0] for day in daily_totals]
+                graph_totals = [day[1] for day in daily_totals]
             
-            cursor.execute("SELECT * FROM students WHERE student_id = ?", (session['user_id'],))
-            student_data = cursor.fetchall()[0]
+                # Prepare donut chart data for Chart.js
+                class_name = []
+                colour_data = []
             
-            # Prepare donut chart data for Chart.js
-            class_name = []
-            colour_data = []
-            
-            if classes and time_data:
-                for i, class_info in enumerate(classes):
-                    if i < len(time_data) and time_data[i] > 0:  # Only include classes with study time
-                        class_name.append(class_info[1])  # class name
-                        colour_data.append(class_info[2])  # class colour
+                if classes and time_data:
+                    for i, class_info in enumerate(classes):
+                        if i < len(time_data) and time_data[i] > 0:  # Only include classes with study time
+                            class_name.append(class_info[1])  # class name
+                            colour_data.append(class_info[2])  # class colour
                 
-                # Filter time_data to match the filtered classes
-                filtered_time_data = [time_data[i] for i, class_info in enumerate(classes) if i < len(time_data) and time_data[i] > 0]
-                time_data = filtered_time_data
+                    # Filter time_data to match the filtered classes
+                    filtered_time_data = [time_data[i] for i, class_info in enumerate(classes) if i < len(time_data) and time_data[i] > 0]
+                    time_data = filtered_time_data
             
-            return render_template('dashboard.html', 
-                                 task_data=task_data, 
-                                 user_data=student_data, 
-                                 colours=COLOURS, 
-                                 classes=classes, 
-                                 sessions=sessions, 
-                                 graph_days=graph_days, 
-                                 graph_totals=graph_totals,
-                                 donut_labels=class_name,
-                                 donut_data=time_data,
-                                 donut_colors=colour_data)  
+                return dict(task_data=task_data, 
+                            user_data=student_data, 
+                            colours=COLOURS, 
+                            classes=classes, 
+                            sessions=sessions, 
+                            graph_days=graph_days, 
+                            graph_totals=graph_totals,
+                            donut_labels=class_name,
+                            donut_data=time_data,
+                            donut_colors=colour_data)  
+            return render_cached('dashboard.html', ('student', session['user_id']),
+                                 view_versions(cursor, 'student', session['user_id']), dashboard_context)
         else:
-            cursor.execute("""
-                SELECT c.*, COUNT(cs.student_id) as student_count 
-                FROM classes c 
-                LEFT JOIN classes_students cs ON c.class_id = cs.class_id 
-                WHERE c.teacher_id = ? 
-                GROUP BY c.class_id
-            """, (session['user_id'],))
-            classes = cursor.fetchall()
-            cursor.execute("SELECT * FROM teachers WHERE teacher_id = ?", (session['user_id'],))
-            teacher_data = cursor.fetchall()[0]
-            conn.close()
-            return render_template('dashboard.html', user_data=teacher_data, colours=COLOURS, classes=classes)
+            def dashboard_context():
+                cursor.execute("""
+                    SELECT c.*, COUNT(cs.student_id) as student_count 
+                    FROM classes c 
+                    LEFT JOIN classes_students cs ON c.class_id = cs.class_id 
+                    WHERE c.teacher_id = ? 
+                    GROUP BY c.class_id
+                """, (session['user_id'],))
+                classes = cursor.fetchall()
+                teacher_data = get_account(cursor, 'teacher', session['user_id'])
+                return dict(user_data=teacher_data, colours=COLOURS, classes=classes)
+            return render_cached('dashboard.html', ('teacher', session['user_id']),
+                                 view_versions(cursor, 'teacher', session['user_id']), dashboard_context)
 
     else:
         flash('Please login to continue')
         return redirect('/login')
 
 @app.route('/add_study', methods=["GET", "POST"])
+@retry_on_locked
 def add_study():
     if verify():
-        start_study_time = session['start_study_time']
         user_id = session['user_id']
-        if start_study_time:
-            class_id = session['study_class_id']
+        conn = get_db()
+        cursor = conn.cursor()
+        active_timer = get_active_timer(cursor, user_id)
+        if active_timer:
+            class_id, started_ts = active_timer
+            if request.method != 'POST':
+                flash('A study session is already running', 'error')
+                return redirect('/dashboard')
             description = request.form.get('description')
             if not is_valid(description):
                 flash('Please enter a valid description', 'error')
                 return redirect('/dashboard')
-            session['study_class_id'] = None
-            session['timer_sec'] = 0
-            session['timer_min'] = 0
-            session['timer_hr'] = 0
+            # rowcount guards against a second stop request logging the same timer twice
+            cursor.execute("DELETE FROM active_timers WHERE student_id = ? AND started_ts = ?", (user_id, started_ts))
+            if cursor.rowcount != 1:
+                conn.rollback()
+                return redirect('/dashboard')
+            start_study_time = datetime.fromtimestamp(started_ts)
             end_study_time = datetime.now().replace(tzinfo=None)
-            start_study_time = start_study_time.replace(tzinfo=None)
-            study_time = int((end_study_time - start_study_time).total_seconds())
-            conn = sqlite3.connect('study_app.db')
-            cursor = conn.cursor()
-            cursor.execute('''
-            SELECT classes_students.total_study_time 
-                FROM classes_students 
-                WHERE student_id = ?
-                AND class_id = ?''', (user_id, class_id))
-            total_study_time = int(cursor.fetchone()[0])
-            total_study_time += study_time
-            cursor.execute("UPDATE classes_students SET total_study_time = ? WHERE (class_id, student_id) = (?, ?)", (total_study_time, class_id, user_id))
-            cursor.execute('''
-            INSERT INTO study_sessions (class_id, student_id, start_time, end_time, description)
-                VALUES (?, ?, ?, ?, ?)''', (class_id, user_id, start_study_time, end_study_time, description))
+            study_time = insert_study_session(cursor, class_id, user_id, start_study_time, end_study_time, description)
             conn.commit()
-            conn.close()
             flash(f'{time_filter_filter(study_time)} session logged.', 'success')
             app.logger.info(f'Student:{user_id} logged study time')
-            session['start_study_time'] = None
             return redirect('/dashboard')
         else:
-            session['start_study_time'] = datetime.now().replace(tzinfo=None)
-            session['study_class_id'] = request.args.get('class_id')
+            class_id = request.args.get('class_id')
+            # only starts if the student is in the class, OR IGNORE keeps the first start if two arrive together
+            cursor.execute('''
+                INSERT OR IGNORE INTO active_timers (student_id, class_id, started_ts)
+                SELECT student_id, class_id, ? FROM classes_students WHERE student_id = ? AND class_id = ?
+            ''', (to_epoch(datetime.now()), user_id, class_id))
+            if cursor.rowcount == 0:
+                flash('Class not found', 'error')
+            conn.commit()
             return redirect('/dashboard')
     else:
         flash('Please login to continue')
         return redirect('/login')
+
+@app.route('/timer')
+def timer():
+    """Current timer as JSON so the stopwatch can resync now and then, all the counting happens in the browser"""
+    if verify():
+        active_timer = get_active_timer(get_db().cursor(), session['user_id'])
+        if active_timer:
+            return {'running': True, 'class_id': active_timer[0], 'started_ts': active_timer[1], 'now': int(time.time())}
+        return {'running': False, 'now': int(time.time())}
+    else:
+        return {'error': 'Please login to continue'}, 401
   
 @app.route('/sessions')
 def sessions():
     if verify(): 
         session['page'] = 'sessions'
-        conn = sqlite3.connect('study_app.db')
+        conn = get_db()
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT s.session_id, s.start_time, s.end_time, s.description, c.name, c.colour 
-            FROM study_sessions s 
-            JOIN classes c ON s.class_id = c.class_id 
-            WHERE s.student_id = ? 
-            ORDER BY s.end_time DESC
-        ''', (session['user_id'],))
+        per_page = request.args.get('per_page', SESSIONS_PER_PAGE, type=int)
+        per_page = min(max(per_page, 1), MAX_SESSIONS_PER_PAGE)
+        before_ts = request.args.get('before_ts', type=int)
+        before_id = request.args.get('before_id', type=int)
+        # keyset pagination - each page starts after the last (end_ts, session_id) of the previous one
+        if before_ts is not None and before_id:
+            cursor.execute('''
+                SELECT s.session_id, s.start_time, s.end_time, s.description, c.name, c.colour, s.duration_seconds, s.end_ts
+                FROM study_sessions s 
+                JOIN classes c ON s.class_id = c.class_id 
+                WHERE s.student_id = ? 
+                AND (s.end_ts, s.session_id) < (?, ?)
+                ORDER BY s.end_ts DESC, s.session_id DESC
+                LIMIT ?
+            ''', (session['user_id'], before_ts, before_id, per_page + 1))
+        else:
+            cursor.execute('''
+                SELECT s.session_id, s.start_time, s.end_time, s.description, c.name, c.colour, s.duration_seconds, s.end_ts
+                FROM study_sessions s 
+                JOIN classes c ON s.class_id = c.class_id 
+                WHERE s.student_id = ? 
+                ORDER BY s.end_ts DESC, s.session_id DESC
+                LIMIT ?
+            ''', (session['user_id'], per_page + 1))
         session_data = cursor.fetchall()
-        conn.close()
-        return render_template('sessions.html', session_data=session_data)
+        next_page = None
+        if len(session_data) > per_page:  # fetched one extra row to know whether there is another page
+            session_data = session_data[:per_page]
+            last = session_data[-1]
+            next_page = url_for('sessions', before_ts=last[7], before_id=last[0], per_page=per_page)
+        return render_template('sessions.html', session_data=session_data, next_page=next_page, show_newest_link=bool(before_id))
     else:
         flash("Please login to continue", "error")
         return redirect('/login')  
-    
+
+@app.route('/sessions/export')
+@limiter.limit("10 per minute")
+def export_sessions():
+    if verify():
+        export_format = request.args.get('format', 'csv')
+        if export_format not in EXPORT_FORMATS:
+            flash('Invalid export format', 'error')
+            return redirect('/sessions')
+        user_id = session['user_id']
+
+        def generate():
+            # its own connection rather than the pooled one, a slow download would otherwise hold a pool slot until it finished
+            conn = connect_db()
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT s.session_id, c.name, s.start_time, s.end_time, s.duration_seconds, s.description
+                    FROM study_sessions s 
+                    JOIN classes c ON s.class_id = c.class_id 
+                    WHERE s.student_id = ? 
+                    ORDER BY s.end_ts DESC, s.session_id DESC
+                ''', (user_id,))
+                if export_format == 'csv':
+                    yield csv_line(EXPORT_COLUMNS)
+                # iterating the cursor pulls rows from sqlite as they are sent, so memory stays flat however long the history is
+                for row in cursor:
+                    if export_format == 'csv':
+                        yield csv_line(row)
+                    else:
+                        yield json.dumps(dict(zip(EXPORT_COLUMNS, row))) + '\n'
+            finally:
+                conn.close()
+
+        app.logger.info(f'Student:{user_id} exported their sessions as {export_format}')
+        response = Response(stream_with_context(generate()), mimetype=EXPORT_FORMATS[export_format])
+        response.headers['Content-Disposition'] = f'attachment; filename=sessions.{export_format}'
+        return response
+    else:
+        flash("Please login to continue", "error")
+        return redirect('/login')
+
 @app.route('/settings', methods=['GET'])
 def settings():
     if verify():
         session['page'] = 'settings'
-        conn = sqlite3.connect('study_app.db')
+        conn = get_db()
         cursor = conn.cursor()
-        if session['user_type'] == 'student':
-            cursor.execute("SELECT * FROM students WHERE student_id = ?", (session['user_id'],))
-        else:
-            cursor.execute("SELECT * FROM teachers WHERE teacher_id = ?", (session['user_id'],))
-        user_data = cursor.fetchall()[0]
-        conn.close()
+        user_data = get_account(cursor, session['user_type'], session['user_id'])
         #print(user_data)
         return render_template('settings.html', user_data=user_data)
     else:
@@ -1010,22 +2418,18 @@ def settings():
         return redirect('/')
     
 @app.route('/update_username', methods=['POST'])
+@retry_on_locked
 def update_username():
     if verify():
         username = request.form.get('username')
         if is_valid(username) and ' ' not in username:
             user_id = session['user_id']
-            conn = sqlite3.connect('study_app.db')
+            conn = get_db()
             cursor = conn.cursor()
             if not find_duplicate(cursor, username):
-                if session['user_type'] == 'teacher':
-                    cursor.execute('UPDATE teachers SET username = ? WHERE teacher_id = ?', (username, user_id))
-                    app.logger.info(f'Teacher:{user_id} updated their username')
-                else:
-                    cursor.execute('UPDATE students SET username = ? WHERE student_id = ?', (username, user_id))
-                    app.logger.info(f'Student:{user_id} updated their username')
+                cursor.execute('UPDATE accounts SET username = ? WHERE role = ? AND user_id = ?', (username, session['user_type'], user_id))
                 conn.commit()
-                conn.close()
+                app.logger.info(f'{session["user_type"].title()}:{user_id} updated their username')
                 session['username'] = username
                 flash('Username successfully updated', 'success')
                 return redirect('/settings')
@@ -1040,21 +2444,17 @@ def update_username():
         return redirect('/login')
 
 @app.route('/update_display_name', methods=['POST'])
+@retry_on_locked
 def update_display_name():
     if verify():
         display_name = request.form.get('display_name')
         if is_valid(display_name):
             user_id = session['user_id']
-            conn = sqlite3.connect('study_app.db')
+            conn = get_db()
             cursor = conn.cursor()
-            if session['user_type'] == 'teacher':
-                cursor.execute('UPDATE teachers SET name = ? WHERE teacher_id = ?', (display_name, user_id))
-                app.logger.info(f'Teacher:{user_id} updated their display name')
-            else:
-                cursor.execute('UPDATE students SET name = ? WHERE student_id = ?', (display_name, user_id))
-                app.logger.info(f'Student:{user_id} updated their display name')
+            cursor.execute('UPDATE accounts SET name = ? WHERE role = ? AND user_id = ?', (display_name, session['user_type'], user_id))
             conn.commit()
-            conn.close()            
+            app.logger.info(f'{session["user_type"].title()}:{user_id} updated their display name')
             flash('Display name successfully updated', 'success')
             return redirect('/settings')
         else:
@@ -1079,6 +2479,7 @@ def logout():
 
 
 @app.route('/create_class', methods=["POST"])
+@retry_on_locked
 def create_class():
     if verify('teacher'):
         class_name = request.form.get("class_name")
@@ -1093,11 +2494,11 @@ def create_class():
             flash('You have not entered a valid name', 'error')
             return redirect('/dashboard')
         else:
-            conn = sqlite3.connect('study_app.db')
+            conn = get_db()
             cursor = conn.cursor()
             cursor.execute("INSERT INTO classes (name, teacher_id, colour) VALUES (?, ?, ?)", (class_name, teacher_id, colour))
+            allocate_join_code(cursor, cursor.lastrowid)
             conn.commit()
-            conn.close()
             app.logger.info(f'Class:{class_name} created by teacher:{teacher_id}')
             flash('Class created successfully', 'success')
             return redirect('/dashboard')
@@ -1106,6 +2507,7 @@ def create_class():
         return redirect('/login')
     
 @app.route('/update_class', methods=['POST'])
+@retry_on_locked
 def update_class():
     if verify('teacher'):
         edit_class_id = int(request.form.get("class_id"))
@@ -1114,11 +2516,10 @@ def update_class():
             if auth_teacher(session['user_id'], edit_class_id):
                 new_class_name = request.form.get("class_name")
                 if new_class_name and is_valid(new_class_name):
-                    conn = sqlite3.connect('study_app.db')
+                    conn = get_db()
                     cursor = conn.cursor()
                     cursor.execute("UPDATE classes SET name = ?, colour = ? WHERE class_id = ?", (new_class_name, new_colour, edit_class_id))
                     conn.commit()
-                    conn.close()
                     app.logger.info(f'Class:{edit_class_id} updated by teacher:{session["user_id"]}')
                     flash('Class updated successfully', 'success')
                 else:
@@ -1136,22 +2537,21 @@ def update_class():
 
 
 @app.route('/join_code', methods=["GET", "POST"])
+@retry_on_locked
 def join_code():
     if verify():
         join_code = request.form.get("join_code")
         if is_valid(join_code) and len(join_code) == 6 and join_code.isdigit():
             student_id = session['user_id']
-            conn = sqlite3.connect('study_app.db')
+            conn = get_db()
             cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM classes WHERE join_code = ?", (join_code,))
-            class_count = cursor.fetchone()[0]
-            if class_count == 0:
+            cursor.execute("SELECT class_id FROM classes WHERE join_code = ?", (join_code,))
+            class_entity = cursor.fetchone()
+            if not class_entity:
                 flash("We couldn't find the class you were looking for", 'error')
                 return redirect('/dashboard')
             else:
-                cursor.execute("SELECT class_id FROM classes WHERE join_code = ?", (join_code,))
-                class_id = cursor.fetchone()[0]
-                add_student(conn, cursor, student_id, class_id)
+                add_student(conn, cursor, student_id, class_entity[0])
                 return redirect('/dashboard')
         else:
             flash('Please enter a valid join-code', 'error')
@@ -1162,61 +2562,71 @@ def join_code():
         
 @app.route('/view_class/<int:class_id>', methods=['GET', 'POST'])
 @limiter.limit("30 per minute")
+@retry_on_locked
 def view_class(class_id):
     if verify('teacher'):
         if is_valid(str(class_id)):
             session['page'] = 'view_class'
-            join_code = generate_join_code(class_id)
             class_entity = get_class(class_id)
             if class_entity:
                 if auth_teacher(session['user_id'], class_id):
-                    conn = sqlite3.connect('study_app.db')
+                    conn = get_db()
                     cursor = conn.cursor()
+                    join_code = class_entity[3]
                     
                     sort_by = request.args.get('sort_by', 'name')
-                    if sort_by == 'study_time':
-                        cursor.execute('''
-                        SELECT students.student_id, students.name, classes_students.total_study_time
-                            FROM students
-                            JOIN classes_students ON students.student_id = classes_students.student_id
-                            JOIN classes ON classes.class_id = classes_students.class_id
-                            WHERE classes.class_id = ?
-                            ORDER BY classes_students.total_study_time DESC
-                            ''', (class_id,))
-                    else:
+                    def class_context():
+                        if sort_by == 'study_time':
+                            cursor.execute('''
+                            SELECT students.student_id, students.name, classes_students.total_study_time
+                                FROM students
+                                JOIN classes_students ON students.student_id = classes_students.student_id
+                                JOIN classes ON classes.class_id = classes_students.class_id
+                                WHERE classes.class_id = ?
+                                ORDER BY classes_students.total_study_time DESC
+                                ''', (class_id,))
+                        else:
+                            cursor.execute('''
+                            SELECT students.student_id, students.name, classes_students.total_study_time
+                                FROM students
+                                JOIN classes_students ON students.student_id = classes_students.student_id
+                                JOIN classes ON classes.class_id = classes_students.class_id
+                                WHERE classes.class_id = ?
+                                ORDER BY students.name ASC
+                                ''', (class_id,))
+                    
+                        class_data = cursor.fetchall()
+                        g.setdefault('student_names', {}).update((row[0], row[1]) for row in class_data)
                         cursor.execute('''
-                        SELECT students.student_id, students.name, classes_students.total_study_time
-                            FROM students
-                            JOIN classes_students ON students.student_id = classes_students.student_id
-                            JOIN classes ON classes.class_id = classes_students.class_id
-                            WHERE classes.class_id = ?
-                            ORDER BY students.name ASC
+                        SELECT session_id, class_id, student_id, start_time, end_time, description, duration_seconds
+                            FROM study_sessions
+                            WHERE class_id = ?
+                            ORDER BY start_ts DESC
                             ''', (class_id,))
+                        session_data = cursor.fetchall()
+                        session_stats = get_session_stats(cursor, class_id)
                     
-                    class_data = cursor.fetchall()
-                    cursor.execute("SELECT * FROM study_sessions WHERE class_id = ? ORDER BY start_time DESC", (class_id,))
-                    session_data = cursor.fetchall()
-                    
-                    # Get teacher data for get_tasks function
-                    cursor.execute("SELECT * FROM teachers WHERE teacher_id = ?", (session['user_id'],))
-                    teacher_data = cursor.fetchall()[0]
-                    task_data = get_tasks(cursor, teacher_data, class_id)
-                    conn.close()
+                        # Get teacher data for get_tasks function
+                        teacher_data = get_account(cursor, 'teacher', session['user_id'])
+                        task_data = get_tasks(cursor, teacher_data, class_id)
                     
-                    if class_data:
-                        total = 0
-                        sum = 0
-                        for row in class_data:
-                            total += int(row[2])
-                            sum += 1
-                        if total > 0:
-                            average_study_time = round(total/sum, 1)
+                        if class_data:
+                            total = 0
+                            sum = 0
+                            for row in class_data:
+                                total += int(row[2])
+                                sum += 1
+                            if total > 0:
+                                average_study_time = round(total/sum, 1)
+                            else:
+                                average_study_time = 0
                         else:
                             average_study_time = 0
-                    else:
-                        average_study_time = 0
                     
-                    return render_template('view-class.html', class_data=class_data, class_entity=class_entity, average_study_time=average_study_time, join_code=join_code, session_data=session_data, task_data=task_data)
+                        return dict(class_data=class_data, class_entity=class_entity, average_study_time=average_study_time, join_code=join_code, session_data=session_data, session_stats=session_stats, task_data=task_data)
+                    # keyed on the raw argument, the template highlights the sort button only when it was given
+                    return render_cached('view-class.html', ('teacher', session['user_id'], class_id, request.args.get('sort_by')),
+                                         view_versions(cursor, 'teacher', session['user_id'], class_id), class_context)
                 else:
                     flash('You are not the owner of this class', 'error')
                     return redirect('/dashboard')
@@ -1231,13 +2641,14 @@ def view_class(class_id):
         return redirect('/login')
     
 @app.route('/invite_student', methods=['GET', 'POST'])
+@retry_on_locked
 def invite_student():
     if verify('teacher'):
         student_username = request.form.get('student_username')
         class_id = request.form.get("class_id")
         if is_valid(class_id) and is_valid(student_username):
             if auth_teacher(session['user_id'], class_id):
-                conn = sqlite3.connect('study_app.db')
+                conn = get_db()
                 cursor = conn.cursor()
                 cursor.execute('SELECT student_id FROM students WHERE username = ?', (student_username,))
                 student_id = cursor.fetchone()
@@ -1247,7 +2658,6 @@ def invite_student():
                     return redirect(url_for('view_class', class_id=class_id))
                 else:      
                     flash('Student not found', 'error')
-                    conn.close()
                     return redirect(url_for('view_class', class_id=class_id))
             else:
                 flash('You are not the owner of this class', 'error')
@@ -1259,19 +2669,53 @@ def invite_student():
         flash('Please login to continue')
         return redirect('/login')
     
+@app.route('/invite_students', methods=['POST'])
+@limiter.limit("10 per minute")
+@retry_on_locked
+def invite_students():
+    if verify('teacher'):
+        class_id = request.form.get('class_id')
+        if is_valid(class_id) and class_id.isdigit():
+            if auth_teacher(session['user_id'], class_id):
+                usernames = parse_roster(request.form.get('student_usernames'), request.files.get('roster_file'))
+                if not usernames:
+                    flash('Please enter at least one username', 'error')
+                    return redirect(url_for('view_class', class_id=class_id))
+                if len(usernames) > MAX_ROSTER_SIZE:
+                    flash(f'Please invite at most {MAX_ROSTER_SIZE} students at a time', 'error')
+                    return redirect(url_for('view_class', class_id=class_id))
+                conn = get_db()
+                cursor = conn.cursor()
+                results = bulk_add_students(cursor, class_id, usernames)
+                conn.commit()
+                added = sum(1 for username, result in results if result == 'Added')
+                app.logger.info(f'{added} students added to class:{class_id} by teacher:{session["user_id"]}')
+                return render_template('invite-results.html', class_entity=get_class(class_id), results=results, added=added)
+            else:
+                flash('You are not the owner of this class', 'error')
+                return redirect('/dashboard')
+        else:
+            flash('Invalid class id', 'error')
+            return redirect('/dashboard')
+    else:
+        flash('Please login to continue')
+        return redirect('/login')
+
 @app.route('/remove_student', methods=['POST'])
+@retry_on_locked
 def remove_student():
     if verify('teacher'):
         student_id = request.form.get('student_id')
         class_id = request.form.get('class_id')
         if is_valid(student_id) and is_valid(class_id):
             if auth_teacher(session['user_id'], class_id):
-                conn = sqlite3.connect('study_app.db')
+                conn = get_db()
                 cursor = conn.cursor()
                 cursor.execute('DELETE FROM classes_students WHERE student_id = ? AND class_id = ?', (student_id, class_id))
                 cursor.execute('DELETE FROM study_sessions WHERE student_id = ? AND class_id = ?', (student_id, class_id))
+                cursor.execute('DELETE FROM daily_study_totals WHERE student_id = ? AND class_id = ?', (student_id, class_id))
+                cursor.execute('DELETE FROM active_timers WHERE student_id = ? AND class_id = ?', (student_id, class_id))
                 conn.commit()
-                conn.close()
                 app.logger.info(f'Student:{student_id} removed by teacher:{session["user_id"]} from class:{class_id}')
                 flash('Student removed', 'success')
                 return redirect(f'/view_class/{class_id}')
@@ -1286,6 +2730,7 @@ def remove_student():
         return redirect('/login')
 
 @app.route('/edit_study_time', methods=['POST'])
+@retry_on_locked
 def edit_study_time():
     if verify('teacher'):
         student_id = request.form.get('student_id')
@@ -1294,12 +2739,16 @@ def edit_study_time():
         if is_valid_time(new_study_time) and is_valid(student_id) and is_valid(class_id):
             if auth_teacher(session['user_id'], class_id):
                 study_time_seconds = convertToSeconds(new_study_time)
-                conn = sqlite3.connect('study_app.db')
+                conn = get_db()
                 cursor = conn.cursor()
-                cursor.execute('UPDATE classes_students SET total_study_time = ? WHERE student_id = ? AND class_id = ?', (study_time_seconds, student_id, class_id))
-                #print(study_time_seconds)
+                # the teacher's change is kept as an offset from the logged sessions so later sessions still add on top
+                cursor.execute('''
+                UPDATE classes_students
+                    SET study_time_adjustment = study_time_adjustment + (? - total_study_time),
+                        total_study_time = ?
+                    WHERE student_id = ? AND class_id = ?
+                    ''', (study_time_seconds, study_time_seconds, student_id, class_id))
                 conn.commit()
-                conn.close()
                 app.logger.info(f'Study time for student:{student_id} in class:{class_id} updated by teacher:{session["user_id"]}')
                 flash(f'Study time successfully updated', 'success')
                 return redirect(f'/view_class/{class_id}')
@@ -1317,6 +2766,7 @@ def edit_study_time():
         return redirect('/login')
 
 @app.route('/update_session', methods=['POST'])
+@retry_on_locked
 def update_session():
     if verify('teacher'):
         session_id = request.form.get("session_id")
@@ -1324,20 +2774,28 @@ def update_session():
         class_id = request.form.get("class_id")
         if is_valid(session_id) and is_valid(class_id) and is_valid(student_id):
             if auth_teacher(session['user_id'], class_id):
-                duration = math.floor(float(request.form.get("duration")))
                 new_session_duration = request.form.get('new_session_duration')
                 description = request.form.get('session_description')
                 if is_valid_time(new_session_duration) and is_valid(description):
                     new_duration = convertToSeconds(new_session_duration)
-                    conn = sqlite3.connect('study_app.db')
+                    conn = get_db()
                     cursor = conn.cursor()
-                    cursor.execute('SELECT end_time FROM study_sessions WHERE session_id = ?', (session_id,))
-                    end_time = datetime.strptime(cursor.fetchone()[0], "%Y-%m-%d %H:%M:%S.%f")
-                    new_end_time = end_time + timedelta(seconds=(new_duration - duration))
-                    cursor.execute('UPDATE study_sessions SET end_time = ?, description = ? WHERE session_id = ?', (new_end_time, description, session_id))
+                    # the rollup and totals follow the stored row, so it has to belong to the class the teacher owns
+                    cursor.execute('SELECT student_id, start_ts, duration_seconds FROM study_sessions WHERE session_id = ? AND class_id = ?', (session_id, class_id))
+                    study_session = cursor.fetchone()
+                    if not study_session:
+                        flash('Session not found', 'error')
+                        return redirect(f'/view_class/{class_id}')
+                    student_id, start_ts, duration = study_session
+                    new_end_ts = start_ts + new_duration
+                    cursor.execute('''
+                    UPDATE study_sessions
+                        SET end_time = ?, end_ts = ?, duration_seconds = ?, description = ?
+                        WHERE session_id = ?
+                        ''', (datetime.fromtimestamp(new_end_ts), new_end_ts, new_duration, description, session_id))
                     updateTotalStudyTime(cursor, student_id, class_id, new_duration - duration)
+                    add_daily_total(cursor, student_id, class_id, start_ts, new_duration - duration)
                     conn.commit()
-                    conn.close()
                     app.logger.info(f'Session:{session_id} updated by teacher:{session["user_id"]}')
                     flash(f'Session time successfully updated', 'success')
                     return redirect(f'/view_class/{class_id}')
@@ -1355,6 +2813,7 @@ def update_session():
         return redirect('/login')
         
 @app.route('/delete_session', methods=['POST'])
+@retry_on_locked
 def delete_session():
     if verify('teacher'):
         session_id = request.form.get('session_id')
@@ -1362,17 +2821,18 @@ def delete_session():
         student_id = request.form.get('student_id')
         if is_valid(session_id) and is_valid(class_id) and is_valid(student_id):
             if auth_teacher(session['user_id'], class_id):
-                conn = sqlite3.connect('study_app.db')
+                conn = get_db()
                 cursor = conn.cursor()
-                cursor.execute('SELECT * FROM study_sessions WHERE session_id = ?', (session_id,))
-                study_session = cursor.fetchall()[0]
-                end_time = datetime.strptime(study_session[4], "%Y-%m-%d %H:%M:%S.%f")
-                start_time = datetime.strptime(study_session[3], "%Y-%m-%d %H:%M:%S")
-                session_duration = int((end_time - start_time).total_seconds())
+                cursor.execute('SELECT student_id, start_ts, duration_seconds FROM study_sessions WHERE session_id = ? AND class_id = ?', (session_id, class_id))
+                study_session = cursor.fetchone()
+                if not study_session:
+                    flash('Session not found', 'error')
+                    return redirect(f'/view_class/{class_id}')
+                student_id, start_ts, session_duration = study_session
                 updateTotalStudyTime(cursor, student_id, class_id, session_duration * -1)
+                add_daily_total(cursor, student_id, class_id, start_ts, session_duration * -1)
                 cursor.execute('DELETE FROM study_sessions WHERE session_id = ?', (session_id,))
                 conn.commit()
-                conn.close()
                 app.logger.info(f'Session:{session_id} deleted by teacher:{session["user_id"]}')
                 flash(f'Session deleted successfully', 'success')
                 return redirect(f'/view_class/{class_id}')
@@ -1387,18 +2847,19 @@ def delete_session():
         return redirect('/login')
 
 @app.route('/delete_class/<int:class_id>', methods=['POST'])
+@retry_on_locked
 def delete_class(class_id):
     if verify('teacher'):
         if is_valid(class_id):
             if auth_teacher(session['user_id'], class_id):
                 
                 
-                conn = sqlite3.connect('study_app.db')
+                conn = get_db()
                 cursor = conn.cursor()
                 cursor.execute("DELETE FROM classes WHERE class_id = ?", (class_id,))
                 cursor.execute("DELETE FROM classes_students WHERE class_id = ?", (class_id,))
+                cursor.execute("DELETE FROM active_timers WHERE class_id = ?", (class_id,))
                 conn.commit()
-                conn.close()
                 app.logger.info(f'Class:{class_id} deleted by teacher:{session["user_id"]}')
                 flash('Class deleted', 'success')
                 return redirect('/dashboard') #bug here - doens't show on first reload due to js
@@ -1412,34 +2873,38 @@ def delete_class(class_id):
         flash('Please login to continue')
         return redirect('/login')
 
-@app.route('/update_session_timer', methods=['POST'])
-def update_session_timer():
-    data = request.get_json()
-    timer_sec = data.get('timer_sec')
-    timer_min = data.get('timer_min')
-    timer_hr = data.get('timer_hr')
-
-    session['timer_sec'] = timer_sec
-    session['timer_min'] = timer_min
-    session['timer_hr'] = timer_hr
-    return 'f'
-
 @app.route('/reload_join_code', methods=['POST'])
+@retry_on_locked
 def reload_join_code():
-    generate_join_code()
-    return render_template('view_class')
+    if verify('teacher'):
+        class_id = request.form.get('class_id')
+        if is_valid(class_id) and class_id.isdigit():
+            if auth_teacher(session['user_id'], class_id):
+                conn = get_db()
+                cursor = conn.cursor()
+                allocate_join_code(cursor, class_id)
+                conn.commit()
+                app.logger.info(f'Join code for class:{class_id} changed by teacher:{session["user_id"]}')
+                flash('Join code changed', 'success')
+                return redirect(f'/view_class/{class_id}')
+            else:
+                flash('You are not the owner of this class', 'error')
+                return redirect('/dashboard')
+        else:
+            flash('Invalid class id', 'error')
+            return redirect('/dashboard')
+    else:
+        flash('Please login to continue', 'error')
+        return redirect('/login')
 
 @app.route('/cancel_mfa')
+@retry_on_locked
 def cancel_mfa():
     if verify():
-        conn = sqlite3.connect('study_app.db')
+        conn = get_db()
         cursor = conn.cursor()
-        if session['user_type'] == 'student':
-            cursor.execute("UPDATE students SET mfa_secret = ? WHERE student_id = ?", (None, session['user_id']))
-        else:
-            cursor.execute("UPDATE teachers SET mfa_secret = ? WHERE teacher_id = ?", (None, session['user_id']))
+        cursor.execute("UPDATE accounts SET mfa_secret = ? WHERE role = ? AND user_id = ?", (None, session['user_type'], session['user_id']))
         conn.commit()
-        conn.close()  
         return redirect('/dashboard')
     else:
         flash('Please login to continue', 'error')
@@ -1451,6 +2916,10 @@ def page_not_found(e):
 
 @app.errorhandler(Exception)
 def handle_exception(e):
+    if isinstance(e, sqlite3.OperationalError) and is_locked_error(e):
+        app.logger.error(f'Database still locked after retries in {request.endpoint}')
+    else:
+        app.logger.exception(f'Unhandled error in {request.endpoint}')
     flash("An unexpected error occurred. Please try again later.", 'error')
     if session.get('user_id'):
         return redirect(f"/{session['page']}")
@@ -1463,60 +2932,61 @@ def rate_limit_exceeded(e):
     return redirect('/')
 
 @app.route('/delete_account', methods=['POST'])
+@retry_on_locked
 def delete_account():
     if verify():
         user_id = session['user_id']
-        conn = sqlite3.connect('study_app.db')
+        conn = get_db()
         cursor = conn.cursor()
         if session['user_type'] == 'teacher':
             cursor.execute('DELETE FROM classes WHERE teacher_id = ?', (user_id,))
-            cursor.execute('DELETE FROM teachers WHERE teacher_id = ?', (user_id,))
+            cursor.execute("DELETE FROM accounts WHERE role = 'teacher' AND user_id = ?", (user_id,))
             app.logger.info(f'Teacher:{user_id} deleted their account')
         else:
             cursor.execute('DELETE FROM study_sessions WHERE student_id = ?', (user_id,))
+            cursor.execute('DELETE FROM daily_study_totals WHERE student_id = ?', (user_id,))
+            cursor.execute('DELETE FROM active_timers WHERE student_id = ?', (user_id,))
             cursor.execute('DELETE FROM classes_students WHERE student_id = ?', (user_id,))
-            cursor.execute('DELETE FROM students WHERE student_id = ?', (user_id,))
+            cursor.execute("DELETE FROM accounts WHERE role = 'student' AND user_id = ?", (user_id,))
             app.logger.info(f'Student:{user_id} deleted their account')
-    conn.commit()
-    conn.close()
-    flash('Account deleted', 'success')
-    return redirect("/logout")
+        conn.commit()
+        flash('Account deleted', 'success')
+        return redirect("/logout")
+    else:
+        flash('Please login to continue', 'error')
+        return redirect('/login')
 
 
 @app.route('/tasks', methods=['GET'])
 def tasks():
     if verify():
         session['page'] = 'tasks'
-        conn = sqlite3.connect('study_app.db')
+        conn = get_db()
         cursor = conn.cursor()
-        if session['user_type'] == 'teacher':
-            cursor.execute("SELECT * FROM teachers WHERE teacher_id = ?", (session['user_id'],))
-            user_data = cursor.fetchall()[0]
-            cursor.execute("SELECT * FROM classes WHERE teacher_id = ?", (session['user_id'],))
-            class_data = cursor.fetchall()
-            
-        else:
-            cursor.execute("SELECT * FROM students WHERE student_id = ?", (session['user_id'],))
-            user_data = cursor.fetchall()[0]
+        def tasks_context():
+            user_data = get_account(cursor, session['user_type'], session['user_id'])
+            if session['user_type'] == 'teacher':
+                cursor.execute("SELECT * FROM classes WHERE teacher_id = ?", (session['user_id'],))
+                class_data = cursor.fetchall()
             
-            cursor.execute('''
-                SELECT classes.* FROM classes 
-                JOIN classes_students ON classes.class_id = classes_students.class_id 
-                WHERE classes_students.student_id = ?
-            ''', (session['user_id'],))
-            class_data = cursor.fetchall()
+            else:
+                cursor.execute('''
+                    SELECT classes.* FROM classes 
+                    JOIN classes_students ON classes.class_id = classes_students.class_id 
+                    WHERE classes_students.student_id = ?
+                ''', (session['user_id'],))
+                class_data = cursor.fetchall()
         
-        task_data = get_tasks(cursor, user_data)
-        #print(task_data)
-
-        conn.close()
-        #print(user_data)
-        return render_template('tasks.html', user_data=user_data, class_data=class_data, task_data=task_data)
+            task_data = get_tasks(cursor, user_data)
+            return dict(user_data=user_data, class_data=class_data, task_data=task_data)
+        return render_cached('tasks.html', (session['user_type'], session['user_id']),
+                             view_versions(cursor, session['user_type'], session['user_id']), tasks_context)
     else:
         flash('Please login to continue', 'error')
         return redirect('/')
     
 @app.route('/create_task', methods=["POST"])
+@retry_on_locked
 def create_task():
     task_description = request.form.get("task_description")
     class_id = request.form.get("class_id")
@@ -1543,31 +3013,23 @@ def create_task():
         
         if verify('teacher'): 
             teacher_id = session['user_id']
-            conn = sqlite3.connect('study_app.db')
+            conn = get_db()
             cursor = conn.cursor()
             
             cursor.execute("INSERT INTO teacher_tasks (class_id, created_at, due_date, duration, description) VALUES (?, ?, ?, ?, ?)", (class_id, created_at, due_date, duration, task_description))
             teacher_task_id = cursor.lastrowid
-            
-            cursor.execute("SELECT student_id FROM classes_students WHERE class_id = ?", (class_id,))
-            student_ids = cursor.fetchall()
-            
-            for student_id in student_ids:
-                cursor.execute("INSERT INTO student_tasks (teacher_task_id, student_id, created_at) VALUES (?, ?, ?)", (teacher_task_id, student_id[0], created_at,))
-            
+            assign_teacher_tasks(cursor, class_id, teacher_task_id=teacher_task_id, created_at=created_at)
             conn.commit()
-            conn.close()
             app.logger.info(f'Task:{task_description} created by teacher:{teacher_id} for ALL students in class:{class_id}')
             flash('Task created successfully', 'success')
             return redirect(request.referrer or f'/{session["page"]}')
         
         elif verify('student'):
             student_id = session['user_id']
-            conn = sqlite3.connect('study_app.db')
+            conn = get_db()
             cursor = conn.cursor()
             cursor.execute("INSERT INTO student_tasks (class_id, student_id, created_at, due_date, duration, description) VALUES (?, ?, ?, ?, ?, ?)", (class_id, student_id, created_at, due_date, duration, task_description))
             conn.commit()
-            conn.close()
             app.logger.info(f'Task:{task_description} created by student:{student_id}')
             flash('Task created successfully', 'success')
             return redirect(f'/{session["page"]}')
@@ -1578,6 +3040,7 @@ def create_task():
     
     
 @app.route('/edit_task', methods=["POST"])
+@retry_on_locked
 def edit_task():
     task_id = request.form.get("task_id")
     task_description = request.form.get("task_description")
@@ -1603,7 +3066,7 @@ def edit_task():
     else:
         if session['user_type'] == 'teacher' and verify('teacher'): 
             teacher_id = session['user_id']
-            conn = sqlite3.connect('study_app.db')
+            conn = get_db()
             cursor = conn.cursor()
             
             # Check if the teacher owns this task
@@ -1626,12 +3089,11 @@ def edit_task():
             else:
                 flash('You are not the owner of this task', 'error')
             
-            conn.close()
             return redirect(request.referrer or f'/{session["page"]}')
 
         elif verify('student'):
             student_id = session['user_id']
-            conn = sqlite3.connect('study_app.db')
+            conn = get_db()
             cursor = conn.cursor()
             
             # Check if the student owns this task (personal task, not assigned)
@@ -1653,7 +3115,6 @@ def edit_task():
             else:
                 flash('You can only edit your own personal tasks', 'error')
             
-            conn.close()
             return redirect(request.referrer or f'/{session["page"]}')
         
         else:
@@ -1661,11 +3122,12 @@ def edit_task():
             return redirect('/login')
     
 @app.route('/delete_task', methods=["POST"])
+@retry_on_locked
 def delete_task():
     task_id = request.form.get("task_id")
     if session['user_type'] == 'teacher' and verify('teacher'): 
         teacher_id = session['user_id']
-        conn = sqlite3.connect('study_app.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # Check if the teacher owns this task
@@ -1687,12 +3149,11 @@ def delete_task():
         else:
             flash('You are not the owner of this task', 'error')
         
-        conn.close()
         return redirect(request.referrer or f'/{session["page"]}')
     
     elif verify('student'):
         student_id = session['user_id']
-        conn = sqlite3.connect('study_app.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # Check if the student owns this task (personal task, not assigned)
@@ -1710,7 +3171,6 @@ def delete_task():
         else:
             flash('You can only delete your own personal tasks', 'error')
         
-        conn.close()
         return redirect(request.referrer or f'/{session["page"]}')
     
     else:
@@ -1718,11 +3178,12 @@ def delete_task():
         return redirect('/login')  
 
 @app.route('/complete_task', methods=["POST"])
+@retry_on_locked
 def complete_task():
     task_id = request.form.get("task_id")
     if verify('student'):
         student_id = session['user_id']
-        conn = sqlite3.connect('study_app.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # Check if the student owns this task 
@@ -1744,7 +3205,6 @@ def complete_task():
         else:
             flash('You can only complete your own tasks', 'error')
         
-        conn.close()
         return redirect(f"/{session['page']}")
     
     else:
@@ -0,0 +1,172 @@
+"""Builds a synthetic database of a given size for benchmarks.
+
+Everything comes from one seeded random.Random, so a tier and seed always
+produce the same teachers, classes, students, study history and tasks.
+Dates are relative to the end date, which defaults to today, so the
+dashboard's last 7/30 day charts always have data. Rows go in with
+executemany and INSERT ... SELECT rather than one statement per row, and
+the daily rollup and class totals are built in one pass at the end.
+
+Every account's password is PASSWORD.
+
+Usage: python bench/dataset.py --tier medium --out medium.db [--seed 1]
+       python bench/dataset.py --teachers 2 --students-per-class 25 --years 0.5 --out custom.db
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_PATH", os.path.join(tempfile.mkdtemp(), "import.db"))
+os.environ.setdefault("LOG_FILE", os.path.join(tempfile.mkdtemp(), "record.log"))
+import app as edura  # noqa: E402
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+PASSWORD = 'Bench-passw0rd'
+# name -> (teachers, classes per teacher, students per class, years of sessions, tasks per class, tasks per student)
+TIERS = {
+    'small': (1, 2, 20, 0.25, 10, 3),
+    'medium': (4, 4, 30, 1, 30, 5),
+    'large': (10, 5, 40, 2, 60, 10),
+}
+DESCRIPTIONS = ["Study session", "Homework", "Reading", "Practice problems", "Review notes", "Project work",
+                "Assignment", "Exam prep", "Research", "Group study", "Lab work", "Tutorial"]
+SESSIONS_PER_DAY = 0.8  # average sessions a student logs per day, spread over their classes
+BATCH = 50000
+
+
+def batched(rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def generate(conn, teachers, classes_per_teacher, students_per_class, years, tasks_per_class, tasks_per_student,
+             seed=1, end_date=None):
+    """Fills an empty, migrated database and returns a dict of row counts"""
+    rng = random.Random(seed)
+    end_date = end_date or datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    days = max(int(years * 365), 1)
+    # hashed once with a fast method, the benchmarks set the session directly rather than logging in
+    password = generate_password_hash(PASSWORD, 'pbkdf2:sha256:1000')
+    cursor = conn.cursor()
+
+    class_count = teachers * classes_per_teacher
+    student_count = class_count * students_per_class
+    cursor.executemany("INSERT INTO accounts (role, user_id, username, password, name) VALUES ('teacher', ?, ?, ?, ?)",
+                       [(teacher_id, f'teacher{teacher_id}', password, f'Teacher {teacher_id}') for teacher_id in range(1, teachers + 1)])
+    cursor.executemany("INSERT INTO accounts (role, user_id, username, password, name) VALUES ('student', ?, ?, ?, ?)",
+                       [(student_id, f'student{student_id}', password, f'Student {student_id}') for student_id in range(1, student_count + 1)])
+    cursor.executemany("INSERT INTO classes (class_id, name, teacher_id, join_code, colour) VALUES (?, ?, ?, ?, ?)",
+                       [(class_id, f'Class {class_id}', (class_id - 1) // classes_per_teacher + 1, 100000 + class_id,
+                         edura.COLOURS[class_id % len(edura.COLOURS)]) for class_id in range(1, class_count + 1)])
+
+    # each student is in their home class and, half the time, one other class of the same teacher
+    memberships = {}
+    for student_id in range(1, student_count + 1):
+        home = (student_id - 1) // students_per_class + 1
+        classes = [home]
+        if classes_per_teacher > 1 and rng.random() < 0.5:
+            first = (home - 1) // classes_per_teacher * classes_per_teacher + 1
+            classes.append(rng.choice([class_id for class_id in range(first, first + classes_per_teacher) if class_id != home]))
+        memberships[student_id] = classes
+    cursor.executemany("INSERT INTO classes_students (class_id, student_id, total_study_time) VALUES (?, ?, 0)",
+                       [(class_id, student_id) for student_id, classes in memberships.items() for class_id in classes])
+
+    def sessions():
+        for student_id, classes in memberships.items():
+            for day in range(days):
+                date = end_date - timedelta(days=day)
+                # a day can have 0, 1 or 2 sessions, averaging SESSIONS_PER_DAY
+                for _ in range(2):
+                    if rng.random() >= SESSIONS_PER_DAY / 2:
+                        continue
+                    start = date + timedelta(hours=rng.randint(7, 21), minutes=rng.randint(0, 59))
+                    end = start + timedelta(minutes=rng.randint(5, 120))
+                    start_ts, end_ts = edura.to_epoch(start), edura.to_epoch(end)
+                    yield (rng.choice(classes), student_id, start.isoformat(' '), end.isoformat(' '),
+                           start_ts, end_ts, end_ts - start_ts, rng.choice(DESCRIPTIONS))
+
+    for batch in batched(sessions()):
+        cursor.executemany('''
+            INSERT INTO study_sessions (class_id, student_id, start_time, end_time, start_ts, end_ts, duration_seconds, description)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', batch)
+    edura.rebuild_daily_totals(cursor)
+    cursor.execute('''
+        UPDATE classes_students SET total_study_time = COALESCE((
+            SELECT SUM(duration_seconds) FROM study_sessions s
+            WHERE s.class_id = classes_students.class_id AND s.student_id = classes_students.student_id), 0)
+    ''')
+
+    # teacher tasks are spread over the period, some already past due, then fanned out to every member at once
+    teacher_tasks = []
+    for class_id in range(1, class_count + 1):
+        for task in range(tasks_per_class):
+            created_at = end_date - timedelta(days=rng.randint(0, days))
+            due_date = created_at + timedelta(days=rng.randint(1, 30))
+            teacher_tasks.append((class_id, created_at.isoformat(' '), due_date.date().isoformat(), rng.choice([None, 30, 60]),
+                                  f'{rng.choice(DESCRIPTIONS)} {task + 1}'))
+    cursor.executemany("INSERT INTO teacher_tasks (class_id, created_at, due_date, duration, description) VALUES (?, ?, ?, ?, ?)", teacher_tasks)
+    edura.assign_teacher_tasks(cursor, created_at=end_date.isoformat(' '))
+    cursor.executemany("INSERT INTO student_tasks (class_id, student_id, created_at, due_date, description) VALUES (?, ?, ?, ?, ?)",
+                       [(rng.choice(classes), student_id, (end_date - timedelta(days=rng.randint(0, 30))).isoformat(' '),
+                         (end_date + timedelta(days=rng.randint(-5, 14))).date().isoformat(), f'Own task {task + 1}')
+                        for student_id, classes in memberships.items() for task in range(tasks_per_student)])
+    # about half of all tasks done, picked by id so it doesn't depend on sqlite's random()
+    cursor.execute("UPDATE student_tasks SET completed = 1, completed_at = created_at WHERE (student_task_id * 7919) % 100 < 50")
+    conn.commit()
+
+    return {table: cursor.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in ['accounts', 'classes', 'classes_students', 'study_sessions', 'daily_study_totals', 'teacher_tasks', 'student_tasks']}
+
+
+def build(path, tier=None, seed=1, **sizes):
+    """Creates a fresh database at path from a named tier or explicit sizes and returns its row counts"""
+    if tier:
+        sizes = dict(zip(['teachers', 'classes_per_teacher', 'students_per_class', 'years', 'tasks_per_class', 'tasks_per_student'], TIERS[tier]))
+    for suffix in ['', '-wal', '-shm']:
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    edura.app.config['DATABASE'] = path
+    edura.init_db()
+    conn = edura.connect_db()
+    try:
+        return generate(conn, seed=seed, **sizes)
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--out', required=True, help='database file to create, replaced if it exists')
+    parser.add_argument('--tier', choices=TIERS)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--teachers', type=int, default=1)
+    parser.add_argument('--classes-per-teacher', type=int, default=3)
+    parser.add_argument('--students-per-class', type=int, default=30)
+    parser.add_argument('--years', type=float, default=1)
+    parser.add_argument('--tasks-per-class', type=int, default=20)
+    parser.add_argument('--tasks-per-student', type=int, default=5)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    counts = build(args.out, args.tier, args.seed, teachers=args.teachers, classes_per_teacher=args.classes_per_teacher,
+                   students_per_class=args.students_per_class, years=args.years, tasks_per_class=args.tasks_per_class,
+                   tasks_per_student=args.tasks_per_student)
+    print(f'built {args.out} in {time.perf_counter() - start:.1f}s')
+    for table, count in counts.items():
+        print(f'{table:<20}{count:>10}')
+
+
+if __name__ == '__main__':
+    main()
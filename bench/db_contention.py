@@ -0,0 +1,127 @@
+"""Read/write throughput of the sqlite backend under concurrent load.
+
+Runs the same mix of study-session writes and dashboard reads against a
+fresh database twice: once with sqlite's defaults (rollback journal, no
+pragmas, which is what the app used to run with) and once with the tuned
+settings from app.configure_db. Prints throughput and "database is locked"
+errors for each.
+
+Usage: python bench/db_contention.py [--writers 8] [--readers 8] [--seconds 5]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_PATH", os.path.join(tempfile.mkdtemp(), "import.db"))
+os.environ.setdefault("LOG_FILE", os.path.join(tempfile.mkdtemp(), "record.log"))
+import app as edura  # noqa: E402
+
+STUDENTS = 50
+CLASSES = 5
+
+
+def seed(conn):
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO teachers (teacher_id, username, password, name) VALUES (1, 'bench_teacher', 'x', 'Bench')")
+    for class_id in range(1, CLASSES + 1):
+        cursor.execute("INSERT INTO classes (name, teacher_id, colour) VALUES (?, 1, ?)", (f'Class {class_id}', edura.COLOURS[0]))
+    for student_id in range(1, STUDENTS + 1):
+        cursor.execute("INSERT INTO students (student_id, username, password, name) VALUES (?, ?, 'x', ?)", (student_id, f'bench{student_id}', f'Student {student_id}'))
+        cursor.execute("INSERT INTO classes_students (class_id, student_id, total_study_time) VALUES (?, ?, 0)", (student_id % CLASSES + 1, student_id))
+    conn.commit()
+
+
+def write(conn):
+    student_id = random.randint(1, STUDENTS)
+    class_id = student_id % CLASSES + 1
+    end_time = datetime.now()
+    start_time = end_time - timedelta(minutes=random.randint(5, 90))
+    cursor = conn.cursor()
+    edura.insert_study_session(cursor, class_id, student_id, start_time, end_time, 'Bench')
+    conn.commit()
+
+
+def read(conn):
+    cursor = conn.cursor()
+    student_id = random.randint(1, STUDENTS)
+    cursor.execute("SELECT s.session_id, s.start_time, s.end_time, s.description, c.name, c.colour FROM study_sessions s JOIN classes c ON s.class_id = c.class_id WHERE s.student_id = ? ORDER BY s.end_ts DESC LIMIT 5", (student_id,))
+    cursor.fetchall()
+    edura.get_daily_totals(cursor, student_id, 30)
+
+
+def worker(connect, action, retries, backoff, deadline, stats, lock):
+    conn = connect()
+    done = locked = 0
+    while time.perf_counter() < deadline:
+        for attempt in range(retries + 1):
+            try:
+                action(conn)
+                done += 1
+                break
+            except sqlite3.OperationalError as e:
+                if conn.in_transaction:
+                    conn.rollback()
+                if not edura.is_locked_error(e):
+                    raise
+                if attempt == retries:
+                    locked += 1
+                else:
+                    delay = backoff * (2 ** attempt)
+                    time.sleep(delay + random.uniform(0, delay))
+    conn.close()
+    with lock:
+        stats[action.__name__] += done
+        stats['locked'] += locked
+
+
+def run(profile, args):
+    path = os.path.join(tempfile.mkdtemp(), f'{profile}.db')
+    edura.app.config['DATABASE'] = path
+    if profile == 'default':
+        edura.app.config['DB_JOURNAL_MODE'] = 'DELETE'
+        connect = lambda: sqlite3.connect(path, check_same_thread=False)  # noqa: E731
+        retries = 0
+    else:
+        edura.app.config['DB_JOURNAL_MODE'] = 'WAL'
+        connect = edura.connect_db
+        retries = edura.app.config['DB_WRITE_RETRIES']
+    backoff = edura.app.config['DB_RETRY_BACKOFF']
+    edura.init_db()
+    conn = connect()
+    seed(conn)
+    conn.close()
+
+    stats = {'write': 0, 'read': 0, 'locked': 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.seconds
+    threads = [threading.Thread(target=worker, args=(connect, write, retries, backoff, deadline, stats, lock)) for _ in range(args.writers)]
+    threads += [threading.Thread(target=worker, args=(connect, read, 0, backoff, deadline, stats, lock)) for _ in range(args.readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    print(f'{"profile":<10}{"writes/s":>12}{"reads/s":>12}{"locked":>10}')
+    for profile in ('default', 'tuned'):
+        stats = run(profile, args)
+        print(f'{profile:<10}{stats["write"] / args.seconds:>12.1f}{stats["read"] / args.seconds:>12.1f}{stats["locked"]:>10}')
+
+
+if __name__ == '__main__':
+    main()
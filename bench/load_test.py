@@ -0,0 +1,283 @@
+"""Many students and teachers using the app at once, against a real server.
+
+Builds a dataset with bench/dataset.py, starts the app under werkzeug's
+threaded WSGI server in a separate process (so the load generator doesn't
+share its GIL), and runs one thread per virtual user:
+
+- students log in, then repeatedly open the dashboard, start a timer, study
+  for the think time, stop it via /add_study, open their tasks and tick one
+- teachers log in, then repeatedly open the dashboard, one of their classes
+  and the tasks page
+
+Each step follows redirects like a browser, so its latency includes the page
+the user lands on. A step counts as an error on a 5xx, a connection failure,
+the app's "unexpected error" flash (which is how a locked database reaches
+users) or landing back on the login page. The server's log is read afterwards for writes that hit a locked
+database and were retried, or that were still locked after the retries.
+
+Password hashes use a cheap method so logins measure the app rather than
+scrypt; pass --real-hashing to keep the configured method.
+
+Usage: python bench/load_test.py [--tier medium] [--students 480] [--teachers 4] [--duration 30] [--think 1]
+       python bench/load_test.py --url http://127.0.0.1:8000 --db medium.db   (a server you started on that database)
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode, urlsplit
+
+BENCH_HASH_METHOD = 'pbkdf2:sha256:1000'  # what bench/dataset.py stores
+ERROR_FLASH = b'An unexpected error occurred'
+RATE_LIMIT_FLASH = b'Too many attempts'
+LOGGED_OUT_FLASH = b'Please login to continue'
+
+
+def serve(db, port, log_file, real_hashing):
+    os.environ['DATABASE_PATH'] = db
+    os.environ['LOG_FILE'] = log_file
+    os.environ.setdefault('APP_SECRET_KEY', 'bench')
+    if not real_hashing:
+        os.environ['PASSWORD_HASH_METHOD'] = BENCH_HASH_METHOD
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from werkzeug.serving import make_server
+    import app as edura
+    # every virtual user comes from 127.0.0.1, per IP limits would just turn most logins away
+    edura.limiter.enabled = False
+    make_server('127.0.0.1', port, edura.app, threaded=True).serve_forever()
+
+
+class Browser:
+    """One keep-alive connection and cookie jar per virtual user"""
+    def __init__(self, url, results):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.connection = None
+        self.cookies = {}
+        self.results = results
+
+    def send(self, method, path, form=None):
+        body = urlencode(form) if form else None
+        headers = {'Cookie': '; '.join(f'{name}={value}' for name, value in self.cookies.items())}
+        if body:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.host, self.port, timeout=60)
+            try:
+                self.connection.request(method, path, body, headers)
+                response = self.connection.getresponse()
+                content = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                # the server closed an idle keep-alive connection, reconnect once
+                self.connection.close()
+                self.connection = None
+                if attempt:
+                    raise
+        # cookies are handled by hand so the Secure flag doesn't stop them going over plain http
+        for header in response.headers.get_all('Set-Cookie') or []:
+            for name, morsel in SimpleCookie(header).items():
+                if morsel['max-age'] == '0' or not morsel.value:
+                    self.cookies.pop(name, None)
+                else:
+                    self.cookies[name] = morsel.value
+        return response.status, response.getheader('Location'), content
+
+    def step(self, name, method, path, form=None):
+        start = time.perf_counter()
+        outcome = 'ok'
+        try:
+            status, location, content = self.send(method, path, form)
+            for _ in range(5):
+                if status not in (301, 302, 303) or not location:
+                    break
+                status, location, content = self.send('GET', urlsplit(location).path or '/')
+            if status >= 500:
+                outcome = f'http {status}'
+            elif ERROR_FLASH in content:
+                outcome = 'error page'
+            elif RATE_LIMIT_FLASH in content:
+                outcome = 'rate limited'
+            elif LOGGED_OUT_FLASH in content:
+                outcome = 'logged out'
+        except (OSError, http.client.HTTPException) as e:
+            outcome = type(e).__name__
+        self.results.append((name, time.perf_counter() - start, outcome))
+
+
+def think(seconds):
+    time.sleep(random.uniform(seconds * 0.5, seconds * 1.5))
+
+
+def student_journey(browser, user, deadline, think_time):
+    browser.step('login', 'POST', '/login', {'username': user['username'], 'password': user['password']})
+    while time.time() < deadline:
+        browser.step('dashboard', 'GET', '/dashboard')
+        browser.step('start timer', 'GET', f'/add_study?class_id={user["class_id"]}')
+        think(think_time)
+        browser.step('stop timer', 'POST', '/add_study', {'description': 'Load test'})
+        browser.step('tasks', 'GET', '/tasks')
+        browser.step('toggle task', 'POST', '/complete_task', {'task_id': user['task_id']})
+        think(think_time)
+
+
+def teacher_journey(browser, user, deadline, think_time):
+    browser.step('login', 'POST', '/login', {'username': user['username'], 'password': user['password']})
+    while time.time() < deadline:
+        browser.step('teacher dashboard', 'GET', '/dashboard')
+        browser.step('view_class', 'GET', f'/view_class/{random.choice(user["class_ids"])}')
+        browser.step('teacher tasks', 'GET', '/tasks')
+        think(think_time)
+
+
+def load_users(db, students, teachers, password):
+    import sqlite3
+    conn = sqlite3.connect(db)
+    student_rows = conn.execute('''
+        SELECT a.username, MIN(cs.class_id), (SELECT MIN(st.student_task_id) FROM student_tasks st WHERE st.student_id = a.user_id)
+        FROM accounts a JOIN classes_students cs ON cs.student_id = a.user_id
+        WHERE a.role = 'student' GROUP BY a.user_id ORDER BY a.user_id LIMIT ?
+    ''', (students,)).fetchall()
+    teacher_rows = conn.execute('''
+        SELECT a.username, GROUP_CONCAT(c.class_id) FROM accounts a JOIN classes c ON c.teacher_id = a.user_id
+        WHERE a.role = 'teacher' GROUP BY a.user_id ORDER BY a.user_id LIMIT ?
+    ''', (teachers,)).fetchall()
+    conn.close()
+    return ([{'username': username, 'password': password, 'class_id': class_id, 'task_id': task_id} for username, class_id, task_id in student_rows],
+            [{'username': username, 'password': password, 'class_ids': class_ids.split(',')} for username, class_ids in teacher_rows])
+
+
+def wait_for(url, timeout=30):
+    parts = urlsplit(url)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=1)
+            connection.request('GET', '/health')
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'server at {url} did not come up')
+
+
+def percentile(timings, fraction):
+    ordered = sorted(timings)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def server_lock_counts(log_file):
+    """(retried, still locked after retries) per route, from the server's JSON log"""
+    retried, failed = Counter(), Counter()
+    if not log_file or not os.path.exists(log_file):
+        return retried, failed
+    with open(log_file) as log:
+        for line in log:
+            record = json.loads(line)
+            if record['message'].startswith('Database locked in'):
+                retried[record.get('route')] += 1
+            elif record['message'].startswith('Database still locked after retries'):
+                failed[record.get('route')] += 1
+    return retried, failed
+
+
+def report(results, elapsed, log_file):
+    by_step = defaultdict(list)
+    for name, seconds, outcome in results:
+        by_step[name].append((seconds, outcome))
+    errors = sum(1 for *_, outcome in results if outcome != 'ok')
+    print(f'\n{len(results)} steps in {elapsed:.1f}s = {len(results) / elapsed:.1f} steps/s, '
+          f'{errors} errors ({errors / max(len(results), 1):.2%})')
+    print(f'{"step":<20}{"count":>8}{"errors":>8}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"max ms":>10}')
+    for name, samples in by_step.items():
+        timings = [seconds * 1000 for seconds, _ in samples]
+        step_errors = sum(1 for _, outcome in samples if outcome != 'ok')
+        print(f'{name:<20}{len(samples):>8}{step_errors:>8}{statistics.median(timings):>10.1f}'
+              f'{percentile(timings, 0.95):>10.1f}{percentile(timings, 0.99):>10.1f}{max(timings):>10.1f}')
+    outcomes = Counter(outcome for *_, outcome in results if outcome != 'ok')
+    if outcomes:
+        print('errors by kind: ' + ', '.join(f'{kind} {count}' for kind, count in outcomes.most_common()))
+    retried, failed = server_lock_counts(log_file)
+    if log_file:
+        print(f'database locked: {sum(retried.values())} writes retried, {sum(failed.values())} still locked after retries (server log {log_file})')
+        for route in sorted(set(retried) | set(failed), key=str):
+            print(f'  {route}: {retried[route]} retried, {failed[route]} failed')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tier', default='medium', help='dataset tier to build (see bench/dataset.py)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--students', type=int, default=480)
+    parser.add_argument('--teachers', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=30, help='seconds each user keeps going after logging in')
+    parser.add_argument('--ramp', type=float, default=5, help='seconds over which users start')
+    parser.add_argument('--think', type=float, default=1, help='average seconds between steps, also how long each timer runs')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--real-hashing', action='store_true')
+    parser.add_argument('--url', help='use an already running server instead of starting one')
+    parser.add_argument('--db', help='database the server at --url is using')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--log-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args.db, args.port, args.log_file, args.real_hashing)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import dataset
+    server, log_file = None, None
+    if args.url:
+        if not args.db:
+            parser.error('--url needs --db so the harness knows the users')
+        url, db = args.url, args.db
+    else:
+        workdir = tempfile.mkdtemp()
+        db, log_file = os.path.join(workdir, f'{args.tier}.db'), os.path.join(workdir, 'server.log')
+        start = time.perf_counter()
+        dataset.build(db, args.tier, args.seed)
+        print(f'built {args.tier} dataset in {time.perf_counter() - start:.1f}s')
+        url = f'http://127.0.0.1:{args.port}'
+        command = [sys.executable, os.path.abspath(__file__), '--serve', '--db', db, '--port', str(args.port), '--log-file', log_file]
+        if args.real_hashing:
+            command.append('--real-hashing')
+        server = subprocess.Popen(command, stderr=subprocess.DEVNULL)
+    try:
+        wait_for(url)
+        students, teachers = load_users(db, args.students, args.teachers, dataset.PASSWORD)
+        print(f'{len(students)} students and {len(teachers)} teachers for {args.duration:.0f}s against {url}')
+        results, threads = [], []
+        deadline = time.time() + args.ramp + args.duration
+        users = [(student_journey, user) for user in students] + [(teacher_journey, user) for user in teachers]
+        random.Random(args.seed).shuffle(users)
+        for journey, user in users:
+            user_results = []
+            results.append(user_results)
+            threads.append(threading.Thread(target=journey, args=(Browser(url, user_results), user, deadline, args.think), daemon=True))
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+            time.sleep(args.ramp / len(threads))
+        for thread in threads:
+            thread.join()
+        report([result for user_results in results for result in user_results], time.perf_counter() - started, log_file)
+    finally:
+        if server is not None:
+            # SIGINT rather than terminate so the server exits normally and flushes its log queue
+            server.send_signal(signal.SIGINT)
+            server.wait(timeout=30)
+
+
+if __name__ == '__main__':
+    main()
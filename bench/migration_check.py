@@ -0,0 +1,83 @@
+"""Checks that teachers renamed by the accounts migration can still log in.
+
+Builds a database at schema version 7, with separate students and teachers
+tables, where a teacher and a student share a username. It then applies the
+remaining migrations and logs in through the Flask test client with the
+username the teacher was given. A second database simulates one migrated by
+the old name_teacherN rename and checks that migration 11 repairs it.
+
+Usage: python bench/migration_check.py
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_PATH", os.path.join(tempfile.mkdtemp(), "import.db"))
+os.environ.setdefault("LOG_FILE", os.path.join(tempfile.mkdtemp(), "record.log"))
+os.environ.setdefault("APP_SECRET_KEY", "bench")
+import app as edura  # noqa: E402
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+PASSWORD = 'Bench-passw0rd'
+
+
+def build(version):
+    """A fresh database with only the migrations up to version applied"""
+    edura.get_pool().close_all()
+    edura.app.config['DATABASE'] = os.path.join(tempfile.mkdtemp(), f'v{version}.db')
+    migrations = edura.MIGRATIONS
+    edura.MIGRATIONS = [entry for entry in migrations if entry[0] <= version]
+    try:
+        edura.init_db()
+    finally:
+        edura.MIGRATIONS = migrations
+    return edura.connect_db()
+
+
+def can_log_in(username):
+    client = edura.app.test_client()
+    client.environ_base['wsgi.url_scheme'] = 'https'  # session cookie is secure-only
+    response = client.post('/login', data={'username': username, 'password': PASSWORD})
+    # a successful login goes on to the MFA step, a failed one back to /login with a flash
+    return response.status_code == 302 and 'mfa' in response.location
+
+
+def teacher_username(conn, teacher_id):
+    return conn.execute("SELECT username FROM accounts WHERE role = 'teacher' AND user_id = ?", (teacher_id,)).fetchone()[0]
+
+
+def main():
+    edura.limiter.enabled = False
+    password = generate_password_hash(PASSWORD, 'pbkdf2:sha256:1000')
+    results = []
+
+    conn = build(7)
+    conn.execute("INSERT INTO students (student_id, username, password, name) VALUES (1, 'alex', ?, 'Alex')", (password,))
+    # the obvious new name is already taken, so the rename has to pick another
+    conn.execute("INSERT INTO students (student_id, username, password, name) VALUES (2, 'alex-teacher3', ?, 'Other')", (password,))
+    conn.execute("INSERT INTO teachers (teacher_id, username, password, name) VALUES (3, 'alex', ?, 'Alex')", (password,))
+    conn.commit()
+    edura.init_db()
+    renamed = teacher_username(conn, 3)
+    results.append((f'clashing teacher renamed to {renamed} and can log in',
+                    edura.is_valid(renamed) and renamed not in ('alex', 'alex-teacher3') and can_log_in(renamed)))
+    results.append(('student keeps the original username', can_log_in('alex')))
+    conn.close()
+
+    conn = build(10)
+    conn.execute("INSERT INTO teachers (teacher_id, username, password, name) VALUES (4, 'sam_teacher4', ?, 'Sam')", (password,))
+    conn.commit()
+    edura.init_db()
+    repaired = teacher_username(conn, 4)
+    results.append((f'sam_teacher4 repaired to {repaired} and can log in',
+                    repaired == 'sam-teacher4' and can_log_in(repaired)))
+    conn.close()
+
+    for description, ok in results:
+        print(f'{"ok" if ok else "FAIL":<6}{description}')
+    sys.exit(0 if all(ok for _, ok in results) else 1)
+
+
+if __name__ == '__main__':
+    main()
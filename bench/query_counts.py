@@ -0,0 +1,87 @@
+"""Checks that teacher pages run a constant number of SQL statements.
+
+Seeds a small and a large class, renders /tasks and /view_class/<id> for
+each through the Flask test client and counts the statements executed. The
+counts must not grow with the number of students or tasks, which catches
+per-row queries creeping back into templates and filters.
+
+Usage: python bench/query_counts.py
+"""
+import os
+import sys
+import tempfile
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_PATH", os.path.join(tempfile.mkdtemp(), "import.db"))
+os.environ.setdefault("LOG_FILE", os.path.join(tempfile.mkdtemp(), "record.log"))
+os.environ.setdefault("APP_SECRET_KEY", "bench")
+os.environ.setdefault("VIEW_CACHE_MAX_BYTES", "0")  # a cached page runs no queries, count the real render path
+import app as edura  # noqa: E402
+
+# (students, tasks) per tier
+TIERS = [(5, 3), (40, 20)]
+statements = []
+
+
+def counting_connect(connect):
+    def wrapper():
+        conn = connect()
+        conn.set_trace_callback(statements.append)
+        return conn
+    return wrapper
+
+
+def seed(students, tasks):
+    conn = edura.connect_db()
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO teachers (teacher_id, username, password, name) VALUES (1, 'teacher', 'x', 'Teacher')")
+    cursor.execute("INSERT INTO classes (name, teacher_id, colour) VALUES ('Class', 1, ?)", (edura.COLOURS[0],))
+    for student_id in range(1, students + 1):
+        cursor.execute("INSERT INTO students (student_id, username, password, name) VALUES (?, ?, 'x', ?)", (student_id, f's{student_id}', f'Student {student_id}'))
+        cursor.execute("INSERT INTO classes_students (class_id, student_id, total_study_time) VALUES (1, ?, 600)", (student_id,))
+        edura.insert_study_session(cursor, 1, student_id, datetime(2024, 1, 1, 10), datetime(2024, 1, 1, 10, 10), 'Reading')
+    for task in range(tasks):
+        cursor.execute("INSERT INTO teacher_tasks (class_id, created_at, description) VALUES (1, '2024-01-01 09:00:00', ?)", (f'Task {task}',))
+        cursor.execute("INSERT INTO student_tasks (teacher_task_id, student_id, created_at, completed) SELECT ?, student_id, '2024-01-01 09:00:00', student_id % 2 FROM classes_students WHERE class_id = 1", (cursor.lastrowid,))
+    conn.commit()
+    conn.close()
+
+
+def count(client, path):
+    client.get(path)  # warm the pool so connection setup isn't counted
+    statements.clear()
+    response = client.get(path)
+    assert response.status_code == 200, f'{path} returned {response.status_code}'
+    return len(statements)
+
+
+def main():
+    edura.app.config['TESTING'] = True
+    edura.limiter.enabled = False
+    edura.connect_db = counting_connect(edura.connect_db)
+
+    results = {}
+    for students, tasks in TIERS:
+        edura.get_pool().close_all()
+        edura.app.config['DATABASE'] = os.path.join(tempfile.mkdtemp(), 'counts.db')
+        edura.init_db()
+        seed(students, tasks)
+        client = edura.app.test_client()
+        client.environ_base['wsgi.url_scheme'] = 'https'  # session cookie is secure-only
+        with client.session_transaction() as session:
+            session.update(user_id=1, user_type='teacher', username='teacher', csrf_token='bench', page='tasks')
+        for path in ('/tasks', '/view_class/1'):
+            results.setdefault(path, []).append(count(client, path))
+
+    failures = 0
+    for path, counts in results.items():
+        ok = len(set(counts)) == 1
+        failures += not ok
+        tiers = ', '.join(f'{s}x{t}: {c}' for (s, t), c in zip(TIERS, counts))
+        print(f'{"ok" if ok else "FAIL":<6}{path} statements per render ({tiers})')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Checks that the hot queries use the indexes added by the schema migrations.
+
+Builds a fully migrated database and records EXPLAIN QUERY PLAN for each
+query, then drops the index the query relies on inside a transaction, records
+the plan again and rolls back. A query fails the check if the migrated plan
+doesn't use the index it is expected to.
+
+Usage: python bench/query_plans.py [-v]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_PATH", os.path.join(tempfile.mkdtemp(), "import.db"))
+os.environ.setdefault("LOG_FILE", os.path.join(tempfile.mkdtemp(), "record.log"))
+import app as edura  # noqa: E402
+
+# (description, sql, params, index expected after migrating)
+QUERIES = [
+    ('dashboard recent sessions',
+     "SELECT s.session_id, s.start_time, s.end_time, s.description, c.name, c.colour FROM study_sessions s JOIN classes c ON s.class_id = c.class_id WHERE s.student_id = ? ORDER BY s.end_ts DESC LIMIT 5",
+     (1,), 'idx_study_sessions_student_end_ts'),
+    ('sessions page',
+     "SELECT s.session_id, s.duration_seconds, s.end_ts FROM study_sessions s JOIN classes c ON s.class_id = c.class_id WHERE s.student_id = ? AND (s.end_ts, s.session_id) < (?, ?) ORDER BY s.end_ts DESC, s.session_id DESC LIMIT ?",
+     (1, 0, 0, 51), 'idx_study_sessions_student_end_ts'),
+    ('daily totals rebuild',
+     "SELECT DATE(start_ts, 'unixepoch', 'localtime') AS day, SUM(duration_seconds) FROM study_sessions WHERE student_id = ? AND start_ts >= ? GROUP BY day",
+     (1, 0), 'idx_study_sessions_student_start_ts'),
+    ('view_class sessions',
+     "SELECT session_id, class_id, student_id, start_time, end_time, description, duration_seconds FROM study_sessions WHERE class_id = ? ORDER BY start_ts DESC",
+     (1,), 'idx_study_sessions_class_start_ts'),
+    ('teacher task completion',
+     "SELECT st.teacher_task_id, st.student_id, st.completed, s.name FROM teacher_tasks t JOIN classes c ON t.class_id = c.class_id JOIN student_tasks st ON t.teacher_task_id = st.teacher_task_id LEFT JOIN students s ON st.student_id = s.student_id WHERE c.teacher_id = ? ORDER BY st.completed DESC, s.name",
+     (1,), 'idx_student_tasks_teacher_task'),
+    ('student tasks',
+     "SELECT st.student_task_id FROM student_tasks st WHERE st.student_id = ? ORDER BY st.completed, st.created_at DESC",
+     (1,), 'idx_student_tasks_student'),
+    ('late joiner task assignment',
+     "SELECT t.teacher_task_id FROM teacher_tasks t JOIN classes_students cs ON cs.class_id = t.class_id WHERE NOT EXISTS (SELECT 1 FROM student_tasks st WHERE st.teacher_task_id = t.teacher_task_id AND st.student_id = cs.student_id) AND t.class_id = ? AND cs.student_id = ?",
+     (1, 1), 'idx_student_tasks_task_student'),
+    ('login lookup',
+     "SELECT role, user_id, password, mfa_secret FROM accounts WHERE username = ?",
+     ('student1',), 'idx_accounts_username'),
+    ('teacher classes',
+     "SELECT * FROM classes WHERE teacher_id = ?",
+     (1,), 'idx_classes_teacher'),
+    ('student classes',
+     "SELECT class_id, total_study_time FROM classes_students WHERE student_id = ? ORDER BY class_id DESC",
+     (1,), 'idx_classes_students_student'),
+]
+
+
+def explain(conn, sql, params):
+    return [row[-1] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params).fetchall()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-v', '--verbose', action='store_true', help='print every plan')
+    args = parser.parse_args()
+
+    edura.app.config['DATABASE'] = os.path.join(tempfile.mkdtemp(), 'plans.db')
+    edura.init_db()
+    # statement caching would hand back the plan prepared before the index was dropped
+    conn = sqlite3.connect(edura.app.config['DATABASE'], cached_statements=0)
+    before = {}
+    after = {}
+    for description, sql, params, index in QUERIES:
+        after[description] = explain(conn, sql, params)
+        conn.execute('BEGIN')
+        conn.execute(f'DROP INDEX IF EXISTS {index}')
+        before[description] = explain(conn, sql, params)
+        conn.rollback()
+    conn.close()
+
+    failures = 0
+    for description, _, _, index in QUERIES:
+        ok = any(index in step for step in after[description])
+        failures += not ok
+        print(f'{"ok" if ok else "FAIL":<6}{description} (expects {index})')
+        if args.verbose or not ok:
+            for label, plan in (('before', before), ('after', after)):
+                for step in plan[description]:
+                    print(f'        {label}: {step}')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""Latency and query counts of the hot routes at each dataset size.
+
+For each tier it builds a database with bench/dataset.py, then drives the
+routes below through the Flask test client as one teacher and one of their
+students, and reports p50/p95 latency and SQL statements per request. The
+statement counts come from the app's own instrumentation (METRICS_ENABLED),
+so they match what /metrics reports. The write routes (starting and stopping
+a timer, ticking a task) really write, so later repeats see a few extra rows,
+and every round invalidates the cached pages the reads depend on. --no-writes
+leaves them out, which shows repeat views served from the page cache.
+
+Usage: python bench/route_latency.py [--tiers small,medium] [--repeats 50] [--seed 1] [--no-writes]
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from flask import g, request_finished
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("APP_SECRET_KEY", "bench")
+import dataset  # noqa: E402  (imports the app with a throwaway database and log file)
+
+edura = dataset.edura
+
+
+def percentile(timings, fraction):
+    ordered = sorted(timings)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def client_for(user_type, user_id, username):
+    client = edura.app.test_client()
+    client.environ_base['wsgi.url_scheme'] = 'https'  # the session cookie is Secure
+    with client.session_transaction() as session:
+        session.update(user_id=user_id, user_type=user_type, username=username, page='dashboard', csrf_token='bench')
+    return client
+
+
+def pick_users(conn):
+    """The first teacher, their first class, and the student in it with the most sessions"""
+    class_id, teacher_id = conn.execute("SELECT class_id, teacher_id FROM classes ORDER BY class_id LIMIT 1").fetchone()
+    student_id = conn.execute('''
+        SELECT cs.student_id FROM classes_students cs
+        LEFT JOIN study_sessions s ON s.student_id = cs.student_id
+        WHERE cs.class_id = ? GROUP BY cs.student_id ORDER BY COUNT(s.session_id) DESC LIMIT 1
+    ''', (class_id,)).fetchone()[0]
+    student_task_id = conn.execute("SELECT student_task_id FROM student_tasks WHERE student_id = ? LIMIT 1", (student_id,)).fetchone()[0]
+    return teacher_id, class_id, student_id, student_task_id
+
+
+def routes(teacher, student, class_id, student_task_id, writes=True):
+    """(name, client, method, path, form data) in the order they're run"""
+    entries = [
+        ('student /dashboard', student, 'GET', '/dashboard', None),
+        ('teacher /dashboard', teacher, 'GET', '/dashboard', None),
+        ('student /tasks', student, 'GET', '/tasks', None),
+        ('teacher /tasks', teacher, 'GET', '/tasks', None),
+        ('teacher /view_class', teacher, 'GET', f'/view_class/{class_id}', None),
+        ('student /sessions', student, 'GET', '/sessions', None),
+        ('start /add_study', student, 'GET', f'/add_study?class_id={class_id}', None),
+        ('stop /add_study', student, 'POST', '/add_study', {'description': 'Bench session'}),
+        ('/complete_task', student, 'POST', '/complete_task', {'task_id': student_task_id}),
+    ]
+    return [entry for entry in entries if writes or entry[2] == 'GET' and not entry[3].startswith('/add_study')]
+
+
+def measure(entries, repeats):
+    """Runs every route once per round so starting and stopping the timer alternate"""
+    timings = {name: [] for name, *_ in entries}
+    queries = {name: [] for name, *_ in entries}
+    for _ in range(repeats):
+        for name, client, method, path, data in entries:
+            start = time.perf_counter()
+            response = client.open(path, method=method, data=data)
+            timings[name].append((time.perf_counter() - start) * 1000)
+            queries[name].append(last_request['sql_queries'])
+            assert response.status_code in (200, 302), f'{method} {path} returned {response.status_code}'
+    return timings, queries
+
+
+last_request = {}
+
+
+def record_queries(sender, response, **extra):
+    last_request['sql_queries'] = g.get('sql_queries', 0)
+
+
+def reset_pool():
+    # pooled connections still point at the previous tier's file
+    pool = edura.app.extensions.pop('db_pool', None)
+    if pool is not None:
+        pool.close_all()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tiers', default='small,medium', help=f'comma separated, from {", ".join(dataset.TIERS)}')
+    parser.add_argument('--repeats', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-writes', action='store_true', help='only the read routes, so cached pages stay valid')
+    args = parser.parse_args()
+
+    edura.app.config['TESTING'] = True
+    edura.app.config['METRICS_ENABLED'] = True
+    edura.limiter.enabled = False
+    request_finished.connect(record_queries, edura.app)
+    print(f'{"tier":<8}{"route":<22}{"p50 ms":>10}{"p95 ms":>10}{"queries":>10}')
+    for tier in args.tiers.split(','):
+        path = os.path.join(tempfile.mkdtemp(), f'{tier}.db')
+        counts = dataset.build(path, tier, args.seed)
+        reset_pool()
+        conn = edura.connect_db()
+        teacher_id, class_id, student_id, student_task_id = pick_users(conn)
+        conn.close()
+        teacher = client_for('teacher', teacher_id, f'teacher{teacher_id}')
+        student = client_for('student', student_id, f'student{student_id}')
+        print(f'{tier:<8}{counts["study_sessions"]} sessions, {counts["student_tasks"]} student tasks, {counts["classes_students"]} enrolments')
+        entries = routes(teacher, student, class_id, student_task_id, not args.no_writes)
+        measure(entries, 1)  # warm up connections and the template cache
+        timings, queries = measure(entries, args.repeats)
+        for name, *_ in entries:
+            low, high = min(queries[name]), max(queries[name])
+            query_range = f'{low}' if low == high else f'{low}-{high}'
+            print(f'{"":<8}{name:<22}{statistics.median(timings[name]):>10.2f}{percentile(timings[name], 0.95):>10.2f}{query_range:>10}')
+        reset_pool()
+
+
+if __name__ == '__main__':
+    main()
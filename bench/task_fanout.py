@@ -0,0 +1,92 @@
+"""Latency of assigning teacher tasks as a class grows.
+
+For classes of 30, 300 and 3000 students (each with some existing tasks) it
+times creating a task the old way (one INSERT per student from Python) and
+with app.assign_teacher_tasks (one INSERT ... SELECT), and times a student
+joining the class and getting its outstanding tasks. Every operation runs in
+a transaction that is rolled back so each repeat sees the same data.
+
+Usage: python bench/task_fanout.py [--repeats 20] [--tasks 20]
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_PATH", os.path.join(tempfile.mkdtemp(), "import.db"))
+os.environ.setdefault("LOG_FILE", os.path.join(tempfile.mkdtemp(), "record.log"))
+import app as edura  # noqa: E402
+
+CLASS_SIZES = [30, 300, 3000]
+
+
+def seed(conn, students, tasks):
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO teachers (teacher_id, username, password, name) VALUES (1, 'teacher', 'x', 'Teacher')")
+    cursor.execute("INSERT INTO classes (name, teacher_id, colour) VALUES ('Class', 1, ?)", (edura.COLOURS[0],))
+    # one extra student who isn't in the class yet, for the join timing
+    cursor.executemany("INSERT INTO students (student_id, username, password, name) VALUES (?, ?, 'x', ?)",
+                       [(student_id, f's{student_id}', f'Student {student_id}') for student_id in range(1, students + 2)])
+    cursor.executemany("INSERT INTO classes_students (class_id, student_id, total_study_time) VALUES (1, ?, 0)",
+                       [(student_id,) for student_id in range(1, students + 1)])
+    for task in range(tasks):
+        cursor.execute("INSERT INTO teacher_tasks (class_id, created_at, due_date, description) VALUES (1, ?, '2999-01-01', ?)", (datetime.now(), f'Task {task}'))
+        edura.assign_teacher_tasks(cursor, 1, teacher_task_id=cursor.lastrowid)
+    conn.commit()
+
+
+def create_task_loop(cursor, students):
+    created_at = datetime.now()
+    cursor.execute("INSERT INTO teacher_tasks (class_id, created_at, description) VALUES (1, ?, 'Bench')", (created_at,))
+    teacher_task_id = cursor.lastrowid
+    cursor.execute("SELECT student_id FROM classes_students WHERE class_id = ?", (1,))
+    for student_id in cursor.fetchall():
+        cursor.execute("INSERT INTO student_tasks (teacher_task_id, student_id, created_at) VALUES (?, ?, ?)", (teacher_task_id, student_id[0], created_at))
+
+
+def create_task_set(cursor, students):
+    created_at = datetime.now()
+    cursor.execute("INSERT INTO teacher_tasks (class_id, created_at, description) VALUES (1, ?, 'Bench')", (created_at,))
+    edura.assign_teacher_tasks(cursor, 1, teacher_task_id=cursor.lastrowid, created_at=created_at)
+
+
+def join_class(cursor, students):
+    cursor.execute("INSERT INTO classes_students (class_id, student_id, total_study_time) VALUES (1, ?, 0)", (students + 1,))
+    edura.assign_teacher_tasks(cursor, 1, student_id=students + 1, outstanding_only=True)
+
+
+def median_ms(conn, action, students, repeats):
+    timings = []
+    for _ in range(repeats):
+        cursor = conn.cursor()
+        start = time.perf_counter()
+        action(cursor, students)
+        timings.append((time.perf_counter() - start) * 1000)
+        conn.rollback()
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--tasks', type=int, default=20, help='existing tasks in each class')
+    args = parser.parse_args()
+
+    actions = [create_task_loop, create_task_set, join_class]
+    print(f'{"students":<10}' + ''.join(f'{action.__name__ + " ms":>22}' for action in actions))
+    for students in CLASS_SIZES:
+        edura.app.config['DATABASE'] = os.path.join(tempfile.mkdtemp(), f'fanout{students}.db')
+        edura.init_db()
+        conn = edura.connect_db()
+        seed(conn, students, args.tasks)
+        results = [median_ms(conn, action, students, args.repeats) for action in actions]
+        conn.close()
+        print(f'{students:<10}' + ''.join(f'{result:>22.2f}' for result in results))
+
+
+if __name__ == '__main__':
+    main()